@@ -353,9 +353,10 @@ class LectureView(AuthModelView):
         'comment': 'Öffentlicher Kommentar (HTML)',
         'validated': 'Überprüft',
         'aliases': 'Aliase',
+        'aliases_text': 'Aliase',
     }
     column_filters = ('id', 'name', 'validated')
-    column_searchable_list = ['name']
+    column_searchable_list = ['name', 'aliases_text']  # both have trigram indexes
     column_default_sort = 'name'
 
 class ExaminantView(AuthModelView):
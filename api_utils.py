@@ -3,22 +3,50 @@
 import config
 import os
 import json
+import math
+import time
+import gzip
+import zlib
+import hashlib
 import datetime
+import collections
 import marshmallow
+import metrics
+import timing
 import traceback
 
 from odie import app, sqla, ClientError
-from login import get_user
+from login import get_user, is_kiosk, route_name
+from cache import LRUCache
+from db.odie import TableVersion
 
-from functools import wraps
-from flask import Flask, Response, request
+from functools import partial, wraps
+from flask import Flask, Response, abort, g, has_request_context, request, stream_with_context
+from itsdangerous import BadSignature, URLSafeSerializer
 from jsonquery import jsonquery
 from marshmallow import Schema, fields
-from sqlalchemy import inspect
+from marshmallow.utils import missing
+from psycopg2.errorcodes import QUERY_CANCELED
+from sqlalchemy import Column, and_, bindparam, event, false, inspect, or_, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.hybrid import HYBRID_PROPERTY
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.orm import lazyload, load_only
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.sql import visitors
+from sqlalchemy.types import TypeEngine
+from sqlalchemy.sql.util import find_tables
 from PyPDF2 import PdfFileReader
 from PyPDF2.utils import PdfReadError
 from pytz import reference
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 def end_of_local_date(d):
     return datetime.datetime.combine(d, datetime.time(23, 59, 59, 999999, tzinfo=reference.LocalTimezone()))
 
@@ -47,10 +75,123 @@ def save_file(document, file_storage):
 
 def serialize(data, schema, many=False):
     try:
-        return schema().dump(data, many=many)
+        with timing.phase('serialize'):
+            instance = schema()
+            dump = _compiled_dump(instance)
+            if dump is None:
+                return instance.dump(data, many=many)
+            if many:
+                return [dump(instance, obj) for obj in data]
+            return dump(instance, data)
     except marshmallow.exceptions.ValidationError as e:
         raise ClientError(str(e), status=400)
 
+
+# Precompiled schemas: marshmallow's generic dump() machinery does a lot of work per row and field that's the same
+# for every row. For schemas marked with @precompiled, serialize() uses specialized functions instead, which produce
+# the exact same output.
+_precompiled_schemas = set()
+_compiled_dumps = {}
+
+
+def precompiled(schema_cls):
+    """Class decorator marking a marshmallow schema whose dumps are compiled (see serialize())
+
+    The schema mustn't have pre_dump/post_dump hooks.
+    """
+    assert not any('dump' in str(tag) for tag, hooks in schema_cls._hooks.items() if hooks), \
+        "can't precompile schemas with dump hooks"
+    _precompiled_schemas.add(schema_cls)
+    return schema_cls
+
+
+def _get_value(obj, key):
+    # same as marshmallow.utils.get_value for undotted keys
+    if not hasattr(obj, '__getitem__'):
+        return getattr(obj, key, missing)
+    try:
+        return obj[key]
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return getattr(obj, key, missing)
+
+
+def _compile_value(field):
+    """Returns a function (value, attribute, obj) -> serialized value for a field
+
+    The common cases get a fast path, everything else is handed to marshmallow.
+    """
+    generic = field._serialize
+    field_type = type(field)
+    if field_type is fields.Integer and not field.as_string:
+        return lambda value, attr, obj: value if type(value) is int else generic(value, attr, obj)
+    if field_type is fields.String:
+        return lambda value, attr, obj: value if type(value) is str else generic(value, attr, obj)
+    if field_type is fields.Boolean:
+        return lambda value, attr, obj: value if value is None or type(value) is bool else generic(value, attr, obj)
+    if field_type is fields.Date and field.format in (None, 'iso', 'iso8601'):
+        return lambda value, attr, obj: value.isoformat() if type(value) is datetime.date else generic(value, attr, obj)
+    return generic
+
+
+def _compile_field(name, field):
+    """Returns a function (schema instance, obj) -> serialized field value (or missing)"""
+    if isinstance(field, fields.Method):
+        method_name = field.serialize_method_name
+        return lambda instance, obj: getattr(instance, method_name)(obj) if method_name else missing
+
+    attribute = field.attribute or name
+    if '.' in attribute or not field._CHECK_ATTRIBUTE:
+        return lambda instance, obj: instance.dump_fields[name].serialize(name, obj, accessor=instance.get_attribute)
+
+    nested = field.inner if isinstance(field, fields.List) else field
+    if isinstance(nested, fields.Nested) and type(nested.schema) in _precompiled_schemas:
+        # nested schema instances belong to the field of the respective parent schema instance
+        if nested is field:
+            nested_schema = lambda instance: instance.dump_fields[name].schema
+        else:
+            nested_schema = lambda instance: instance.dump_fields[name].inner.schema
+
+        def serialize_nested(instance, value):
+            schema = nested_schema(instance)
+            dump = _compiled_dump(schema)
+            if nested is not field or nested.many or schema.many:
+                return [dump(schema, each) for each in value]
+            return dump(schema, value)
+    else:
+        serialize_value = _compile_value(field)
+        serialize_nested = lambda instance, value: serialize_value(value, attribute, None)
+
+    def compiled(instance, obj):
+        value = _get_value(obj, attribute)
+        if value is missing:
+            # defaults are rare, let marshmallow handle them
+            return instance.dump_fields[name].serialize(name, obj, accessor=instance.get_attribute)
+        if value is None:
+            return None
+        return serialize_nested(instance, value)
+    return compiled
+
+
+def _compiled_dump(instance):
+    """Returns the compiled dump function for a schema instance, or None if its schema isn't precompiled"""
+    key = (type(instance), tuple(instance.dump_fields))
+    dump = _compiled_dumps.get(key)
+    if dump is None:
+        if type(instance) not in _precompiled_schemas:
+            return None
+        compiled_fields = [(field.data_key or name, _compile_field(name, field))
+                           for (name, field) in instance.dump_fields.items()]
+
+        def dump(instance, obj):
+            result = {}
+            for (key, compiled) in compiled_fields:
+                value = compiled(instance, obj)
+                if value is not missing:
+                    result[key] = value
+            return result
+        _compiled_dumps[key] = dump
+    return dump
+
 class PaginatedResult(object):
     """Wraps results with pagination metadata"""
 
@@ -63,6 +204,50 @@ class PaginatedResult(object):
         return serialize(self.pagination.items, self.schema, many=True)
 
 
+class StreamedResult(object):
+    """Wraps an unpaginated query whose results are sent while they are still being fetched
+
+    Rows are fetched through a server-side cursor in batches of STREAM_BATCH_SIZE, each batch is serialized and
+    written out on its own, so neither memory usage nor the time to the first byte grows with the table.
+    As with all yield_per() queries, the query mustn't eagerly load collections.
+    """
+
+    def __init__(self, query, schema):
+        self.query = query
+        self.schema = schema
+
+    def _batches(self):
+        batch = []
+        for item in self.query.execution_options(stream_results=True).yield_per(config.STREAM_BATCH_SIZE):
+            batch.append(item)
+            if len(batch) == config.STREAM_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def chunks(self):
+        # same envelope as api_route's {"data": ...}
+        yield '{"data": ['
+        separator = ''
+        batches = self._batches()
+        while True:
+            with timing.phase('stream'):
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                data = serialize(batch, self.schema, many=True)
+                with timing.phase('encode'):
+                    # strip the brackets, we're writing a single list
+                    chunk = separator + json.dumps(data)[1:-1]
+            yield chunk
+            separator = ', '
+        yield ']}'
+
+    def response(self):
+        return Response(stream_with_context(self.chunks()), mimetype='application/json')
+
+
 def deserialize(schema):
     def _decorator(f):
         @wraps(f)
@@ -76,28 +261,379 @@ def deserialize(schema):
     return _decorator
 
 
+def table_versions():
+    """Returns {table name: (version, time of last change)} for all tables in db.odie.VERSIONED_TABLES
+
+    Fetched once per request.
+    """
+    if '_table_versions' not in g:
+        g._table_versions = {v.table_name: (v.version, v.changed_at) for v in TableVersion.query}
+    return g._table_versions
+
+
+def _query_tables(query):
+    return sorted({table.fullname for table in find_tables(query.statement, check_columns=True, include_aliases=True)})
+
+
+class Page(object):
+    """Page of results with optional totals, filtered_results()' replacement for flask_sqlalchemy's Pagination
+    when the total doesn't need to be counted exactly (see endpoint()'s `count` parameter)"""
+
+    def __init__(self, items, page, per_page, total=None):
+        self.items = items
+        self.page = page
+        if total is not None:
+            self.total = total
+            self.pages = int(math.ceil(total / per_page))
+
+
+# Totals for count=estimated, keyed by the filtered query and the versions of the tables it reads
+_count_cache = LRUCache('count_cache', config.COUNT_CACHE_SIZE, ttl=config.COUNT_CACHE_TTL)
+
+
+def _statement_key(query):
+    """Hashable identity of a query's SQL statement and its parameters"""
+    compiled = query.statement.compile(dialect=postgresql.dialect())
+    return (str(compiled), repr(sorted(compiled.params.items())))
+
+
+def _estimated_count(query, check_cost=False):
+    tables = _query_tables(query)
+    versions = table_versions()
+    key = _statement_key(query) + (tuple(versions.get(table) for table in tables),)
+    total = _count_cache.get(key)
+    if total is None:
+        if check_cost:
+            _check_query_cost(query.order_by(None))
+        total = query.order_by(None).count()
+        _count_cache.put(key, total)
+    return total
+
+
+def _paginate(query, page, count, check_cost=False):
+    """check_cost: whether to check the cost of the queries for the page and its total first (see _check_query_cost)"""
+    items_per_page = config.ITEMS_PER_PAGE
+    if count not in ('exact', 'estimated', 'none'):
+        raise ClientError('invalid count mode', status=400)
+    if check_cost and type(page) is int:
+        _check_query_cost(query.limit(items_per_page).offset(max(page - 1, 0) * items_per_page))
+    if count == 'exact':
+        if check_cost:
+            # counting has to go through all matching rows
+            _check_query_cost(query.order_by(None))
+        return query.paginate(page, items_per_page)
+    if page < 1:
+        abort(404)
+    items = query.limit(items_per_page).offset((page - 1) * items_per_page).all()
+    if not items and page != 1:
+        abort(404)
+    total = _estimated_count(query, check_cost) if count == 'estimated' else None
+    return Page(items, page, items_per_page, total)
+
+
 class PaginatedResultSchema(Schema):
     data = fields.Raw()
+    # page-based pagination
     page = fields.Int(attribute='pagination.page')
     number_of_pages = fields.Int(attribute='pagination.pages')
     total = fields.Int(attribute='pagination.total')
+    # cursor-based pagination, see KeysetPagination
+    next = fields.Str(attribute='pagination.next_cursor')
+    prev = fields.Str(attribute='pagination.prev_cursor')
+
+
+class KeysetPagination(object):
+    """Cursor-based counterpart to flask_sqlalchemy's Pagination
+
+    Selected by passing a 'cursor' key in the 'q' parameter (null for the first page, otherwise one of the
+    cursors returned as 'next'/'prev'). Pages are found by seeking to the sort key and id of the last row seen,
+    so neither an OFFSET scan nor a count(*) is needed. Consequently, there are no page numbers or totals.
+    """
+
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+# Cursors are signed, so clients can't use them to probe arbitrary values of the sort column.
+_cursor_serializer = URLSafeSerializer(app.config['SECRET_KEY'], salt='odie-cursor')
+
+
+def _encode_cursor(item, sort_name, descending, backwards):
+    value = getattr(item, sort_name) if sort_name else None
+    kind = None
+    if isinstance(value, datetime.datetime):
+        value, kind = value.isoformat(), 'datetime'
+    elif isinstance(value, datetime.date):
+        value, kind = value.isoformat(), 'date'
+    return _cursor_serializer.dumps([sort_name, descending, backwards, kind, value, item.id])
+
+
+def _decode_cursor(cursor, sort_name, descending):
+    if not isinstance(cursor, str):
+        raise ClientError('invalid cursor', status=400)
+    try:
+        (cursor_sort_name, cursor_descending, backwards, kind, value, id) = _cursor_serializer.loads(cursor)
+    except (BadSignature, ValueError):
+        raise ClientError('invalid cursor', status=400)
+    if (cursor_sort_name, cursor_descending) != (sort_name, descending):
+        raise ClientError('cursor does not match the requested ordering', status=400)
+    if kind == 'datetime':
+        value = datetime.datetime.fromisoformat(value)
+    elif kind == 'date':
+        value = datetime.date.fromisoformat(value)
+    return backwards, value, id
+
+
+def _seek(column, descending, value, id_column, id_descending, id):
+    """Criterion for the rows strictly after (value, id) when ordering by (column, id_column)
+
+    NULLs are treated as larger than any other value, as postgres does.
+    """
+    id_after = id_column < id if id_descending else id_column > id
+    if column is None:
+        return id_after
+    if value is None:
+        beyond = column.isnot(None) if descending else false()
+        same = column.is_(None)
+    else:
+        beyond = column < value if descending else or_(column > value, column.is_(None))
+        same = column == value
+    return or_(beyond, and_(same, id_after))
+
+
+def _sort_column(q, sort_columns, allow_insecure):
+    """Returns (name, descending) of the column a query is ordered by according to the 'q' parameter"""
+    op = q.get('operator')
+    if op in ('order_by_asc', 'order_by_desc') and (allow_insecure or q.get('column') in sort_columns):
+        return q['column'], op == 'order_by_desc'
+    return None, False
+
+
+def _keyset_paginate(query, q, sort_columns, allow_insecure):
+    entity = query.column_descriptions[0]['type']
+    sort_name, descending = _sort_column(q, sort_columns, allow_insecure)
+    column = getattr(entity, sort_name) if sort_name else None
+    backwards, value, id = False, None, None
+    if q['cursor']:
+        backwards, value, id = _decode_cursor(q['cursor'], sort_name, descending)
+
+    # pages before the cursor are fetched in reverse order and flipped afterwards
+    ordering = []
+    if column is not None:
+        ordering.append(column.desc() if descending != backwards else column.asc())
+    ordering.append(entity.id.desc() if backwards else entity.id.asc())
+    query = query.order_by(None).order_by(*ordering)
+    if q['cursor']:
+        query = query.filter(_seek(column, descending != backwards, value, entity.id, backwards, id))
+
+    items_per_page = config.ITEMS_PER_PAGE
+    items = query.limit(items_per_page + 1).all()
+    more = len(items) > items_per_page
+    items = items[:items_per_page]
+    if backwards:
+        items.reverse()
+
+    next_cursor = prev_cursor = None
+    if items and (more or backwards):
+        next_cursor = _encode_cursor(items[-1], sort_name, descending, False)
+    if items and q['cursor'] and (more or not backwards):
+        prev_cursor = _encode_cursor(items[0], sort_name, descending, True)
+    return KeysetPagination(items, next_cursor, prev_cursor)
 
 
 # `allow_insecure` is *insecure* -- see comment in endpoint() regarding the `allow_insecure_authenticated`
 # parameter. Note that in this function, `allow_insecure` does also apply to anonymous users.
-def filtered_results(query, schema, paginate=True, allow_insecure=False):
+# `sort_columns` are the columns the query may be ordered by according to 'q' even if `allow_insecure` is False.
+class _Explain(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_Explain, 'postgresql')
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+# statement key -> (estimated total cost, plan)
+_query_costs = LRUCache('query_cost_cache', config.QUERY_COST_CACHE_SIZE, ttl=config.QUERY_COST_CACHE_TTL)
+
+
+def _check_query_cost(query):
+    """Rejects queries the planner estimates to cost more than JSONQUERY_MAX_COST
+
+    Paginated queries are explained with the LIMIT of the requested page, which is what actually gets run, and once
+    more without it if their total has to be counted.
+    jsonquery's element limits don't stop e.g. `like '%x%'` on unindexed columns from scanning whole tables.
+    """
+    key = _statement_key(query)
+    estimate = _query_costs.get(key)
+    if estimate is None:
+        mapper = inspect(query.column_descriptions[0]['entity'])
+        result = sqla.session.execute(_Explain(query.statement), mapper=mapper).scalar()
+        [explained] = json.loads(result) if isinstance(result, str) else result
+        estimate = (explained['Plan']['Total Cost'], explained['Plan'])
+        _query_costs.put(key, estimate)
+    (cost, plan) = estimate
+    if cost > config.JSONQUERY_MAX_COST:
+        metrics.incr('query_cost_guard', 'rejected')
+        app.logger.warning('Rejected query with estimated cost %s (limit %s) from %s: %s\nparameters: %s\nplan: %s',
+                           cost, config.JSONQUERY_MAX_COST, request.full_path, key[0], key[1], json.dumps(plan))
+        raise ClientError('query too expensive (estimated cost {:.0f}, limit {})'.format(
+            cost, config.JSONQUERY_MAX_COST), status=400)
+    metrics.incr('query_cost_guard', 'admitted')
+
+
+def _requested_fields(schema):
+    """Returns the field names listed in the 'fields' GET-parameter (comma-separated), or None if it's absent"""
+    if 'fields' not in request.args:
+        return None
+    names = list(collections.OrderedDict.fromkeys(name for name in request.args['fields'].split(',') if name))
+    unknown = [name for name in names if name not in schema._declared_fields]
+    if unknown:
+        raise ClientError('unknown fields: ' + ', '.join(unknown))
+    return names
+
+
+def _mapped_columns(mapper, name):
+    """Returns the names of the column attributes the mapped attribute `name` is computed from, or None if that
+    can't be told (plain Python properties)"""
+    if name in mapper.column_attrs:
+        return [name]
+    descriptor = mapper.all_orm_descriptors.get(name)
+    if getattr(descriptor, 'extension_type', None) is not HYBRID_PROPERTY:
+        return None
+    names = []
+    for element in visitors.iterate(getattr(mapper.class_, name), {}):
+        if isinstance(element, Column):
+            try:
+                names.append(mapper.get_property_by_column(element).key)
+            except UnmappedColumnError:
+                return None
+    return names
+
+
+def _sparse_query(query, schema, only):
+    """Restricts query to what serializing the fields `only` of schema needs
+
+    Only the columns backing these fields are loaded, relationships not among them aren't loaded at all.
+    If a field is computed by the schema (Method and Function fields) or backed by a plain Python property, the query
+    is left alone, since there's no telling what it depends on.
+    """
+    if any(isinstance(schema._declared_fields[name], (fields.Method, fields.Function)) for name in only):
+        return query
+    mapper = inspect(query.column_descriptions[0]['entity'])
+    names = [schema._declared_fields[name].attribute or name for name in only]
+    # cursors are made from the sort column
+    q = json.loads(request.args.get('q', '{}'))
+    if not isinstance(q, dict):
+        raise ClientError('q must be a JSON object', status=400)
+    sort_column = q.get('column')
+    if isinstance(sort_column, str) and sort_column in mapper.column_attrs:
+        names.append(sort_column)
+    columns = []
+    relationships = []
+    for name in names:
+        if name in mapper.relationships:
+            relationships.append(name)
+            continue
+        backing = _mapped_columns(mapper, name)
+        if backing is None:
+            return query
+        columns.extend(backing)
+    options = [load_only(*columns)] if columns else []
+    options += [lazyload(relationship.key) for relationship in mapper.relationships
+                if relationship.key not in relationships]
+    return query.options(*options)
+
+
+# Building jsonquery's criterion takes longer than running most of the filtered queries. Criteria only differing in
+# the values compared to are therefore built once (per queried entities) with bound parameters in place of the values.
+# Keys include the lengths of lists, so jsonquery's element limits are checked once per key with the actual values.
+_jsonquery_templates = LRUCache('jsonquery_templates', config.JSONQUERY_TEMPLATE_CACHE_SIZE)
+
+
+def _parameter_type(query, column):
+    """Returns the type of the column named `column` if it can be compared to a bound parameter, else None"""
+    descriptions = query.column_descriptions
+    # the same lookup as jsonquery's
+    attribute = next((desc['expr'] for desc in descriptions if desc['name'] == column), None)
+    if attribute is None and isinstance(column, str):
+        attribute = getattr(descriptions[0]['type'], column, None)
+    type_ = getattr(attribute, 'type', None)
+    return type_ if isinstance(type_, TypeEngine) else None
+
+
+def _parametrize(node, query, values):
+    """Returns a copy of the jsonquery criterion `node` with its values replaced by bound parameters, appending the
+    values to `values`. Values not compared to columns (None, relationships, ...) are kept."""
+    if not isinstance(node, dict) or 'value' not in node:
+        return node
+    (op, value) = (node.get('operator'), node['value'])
+    if op in ('and', 'or') and isinstance(value, list):
+        value = [_parametrize(child, query, values) for child in value]
+    elif op == 'not':
+        value = _parametrize(value, query, values)
+    elif value is not None and (op != 'in_' or isinstance(value, list)):
+        type_ = _parameter_type(query, node.get('column'))
+        if type_ is not None:
+            values.append(value)
+            value = bindparam('jsonquery_%d' % (len(values) - 1), type_=type_, expanding=op == 'in_')
+    return dict(node, value=value)
+
+
+def _jsonquery(query, q):
+    """jsonquery(query, q), reusing the criteria built for earlier queries of the same shape"""
+    op = q.get('operator', '')
+    ordering = op.startswith('order_by')
+    criterion = q.get('value', {}) if ordering else {key: q[key] for key in ('operator', 'column', 'value') if key in q}
+    if isinstance(criterion, dict) and 'value' in criterion:
+        values = []
+        template = _parametrize(criterion, query, values)
+        entities = tuple(desc['expr'] for desc in query.column_descriptions)
+        key = (entities, json.dumps(template, sort_keys=True, default=lambda param: param.key),
+               tuple(len(value) for value in values if isinstance(value, list)))
+        whereclause = _jsonquery_templates.get(key)
+        if whereclause is None:
+            base = query.session.query(*entities)
+            jsonquery(base, criterion)  # validates the actual values
+            whereclause = jsonquery(base, template).whereclause
+            _jsonquery_templates.put(key, whereclause)
+        query = query.filter(whereclause)
+        if values:
+            query = query.params(**{'jsonquery_%d' % i: value for (i, value) in enumerate(values)})
+    elif ordering and 'value' in q:
+        # whatever jsonquery makes of it
+        return jsonquery(query, q)
+    if ordering:
+        query = jsonquery(query, {'operator': op, 'column': q['column']})
+    return query
+
+
+def filtered_results(query, schema, paginate=True, allow_insecure=False, sort_columns=(), count='exact', stream=False):
     q = json.loads(request.args.get('q', '{}'))
-    if allow_insecure:
-        query = jsonquery(query, q) if q else query
+    if allow_insecure and q:
+        query = _jsonquery(query, q)
+    # 'page' or 'cursor' on their own don't make a query any more expensive
+    check_cost = allow_insecure and 'operator' in q
+    items_per_page = config.ITEMS_PER_PAGE
+    if paginate and 'cursor' in q:
+        if check_cost:
+            _check_query_cost(query.limit(items_per_page + 1))
+        return PaginatedResult(_keyset_paginate(query, q, sort_columns, allow_insecure), schema)
     # ensure deterministic ordering
     # (we need this for paginated results with queries involving subqueries)
     # We assume that all queriable tables have an 'id' column
     query = query.order_by('id')
     if not paginate:
+        if check_cost:
+            _check_query_cost(query)
+        if stream:
+            return StreamedResult(query, schema)
         return serialize(query.all(), schema, many=True)
     page = q.get('page', 1)
-    items_per_page = config.ITEMS_PER_PAGE
-    pag = query.paginate(page, items_per_page)
+    pag = _paginate(query, page, request.args.get('count', count), check_cost)
     return PaginatedResult(pag, schema)
 
 
@@ -110,7 +646,8 @@ def jsonify(*args, **kwargs):
             request.accept_mimetypes[best] > \
             request.accept_mimetypes['text/html']
 
-    data = json.dumps(dict(*args, **kwargs))
+    with timing.phase('encode'):
+        data = json.dumps(dict(*args, **kwargs))
     if not get_user() or request_wants_json():
         return Response(data, mimetype='application/json')
     else:
@@ -127,25 +664,250 @@ def handle_client_errors(f):
     return wrapped_f
 
 
+# FS_CONFIG is part of lots of responses, but only changes with a restart
+_CONFIG_DIGEST = hashlib.sha256(json.dumps(config.FS_CONFIG, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _validators(tables, version_interval):
+    """Returns (ETag, Last-Modified) of a GET request to a route whose response only depends on the request,
+    its user, FS_CONFIG, the given tables and, if version_interval isn't None, the current time"""
+    versions = table_versions()
+    changes = [versions.get(table, (0, None)) for table in tables]
+    user = get_user()
+    parts = [request.full_path, request.headers.get('Accept'), user.id if user else None, is_kiosk(),
+             _CONFIG_DIGEST, [version for (version, _) in changes]]
+    modified = [changed_at for (_, changed_at) in changes if changed_at is not None]
+    if version_interval is not None:
+        bucket = int(time.time() // version_interval)
+        parts.append(bucket)
+        modified.append(datetime.datetime.fromtimestamp(bucket * version_interval, datetime.timezone.utc))
+    etag = hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+    return etag, max(modified) if modified else None
+
+
+def _not_modified(etag, last_modified):
+    """Returns the ETag to answer a conditional request with 304, or None if it has to be answered in full"""
+    # If-Modified-Since is ignored in the presence of If-None-Match (RFC 7232, section 3.3)
+    if request.if_none_match:
+        for variant in [etag] + [_variant_etag(etag, encoding) for encoding in _ENCODINGS]:
+            if request.if_none_match.contains_weak(variant):
+                return variant
+        return None
+    since = request.if_modified_since
+    if since is None or last_modified is None:
+        return None
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    return etag if last_modified.replace(microsecond=0) <= since else None
+
+
+# Compression of API responses. Brotli is optional, gzip always available.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# content codings in order of preference
+_ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _compressed_chunks(chunks, encoding, timer):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        (compress, flush, finish) = (compressor.process, compressor.flush, compressor.finish)
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+        (compress, flush, finish) = (compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+                                     compressor.flush)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            # flush every chunk, clients should get rows as soon as they've been fetched
+            with timing.phase('encode', timer):
+                compressed = compress(chunk) + flush()
+            yield compressed
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _variant_etag(etag, encoding):
+    # strong ETags have to differ between content codings
+    return '{}-{}'.format(etag, encoding)
+
+
+class EncodedJSON(object):
+    """JSON response body along with its compressed variants, for routes that cache their serialized responses
+
+    Each variant is only compressed once a client accepts it, and kept from then on, so cache hits don't have to
+    compress anything.
+    """
+    __slots__ = ('body', 'variants', 'size')
+
+    def __init__(self, data):
+        with timing.phase('encode'):
+            self.body = json.dumps(data).encode()
+        self.variants = {}
+        # variants are added after the object has been cached, so they're accounted for in advance
+        # (compressed, they're no larger than the body)
+        variants = len(_ENCODINGS) if len(self.body) >= config.COMPRESSION_MIN_SIZE else 0
+        self.size = len(self.body) * (1 + variants)
+
+    def variant(self, encoding):
+        compressed = self.variants.get(encoding)
+        if compressed is None:
+            with timing.phase('encode'):
+                compressed = self.variants[encoding] = _compress(self.body, encoding)
+        return compressed
+
+
+def _encode_response(response, encoded=None):
+    """Compresses JSON responses of at least COMPRESSION_MIN_SIZE bytes according to Accept-Encoding
+
+    Streamed responses are always compressed (chunk by chunk), if the client accepts it.
+    encoded: the EncodedJSON the response body comes from, if any
+    """
+    if response.status_code != 200 or response.mimetype != 'application/json' or \
+            'Content-Encoding' in response.headers:
+        return
+    if not response.is_streamed and response.calculate_content_length() < config.COMPRESSION_MIN_SIZE:
+        return
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(_ENCODINGS)
+    if encoding is None:
+        return
+    if response.is_streamed:
+        response.response = _compressed_chunks(response.response, encoding, timing.current())
+        response.headers.pop('Content-Length', None)
+    else:
+        if encoded is not None:
+            compressed = encoded.variant(encoding)
+        else:
+            with timing.phase('encode'):
+                compressed = _compress(response.get_data(), encoding)
+        response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    (etag, _) = response.get_etag()
+    if etag:
+        response.set_etag(_variant_etag(etag, encoding))
+
+
+# Every transaction of an API request gets a statement_timeout (on all binds), so a single pathological query can't
+# hold on to a WSGI thread and a pooled connection for as long as Postgres takes.
+@event.listens_for(sqla.session, 'after_begin')
+def _set_statement_timeout(session, transaction, connection):
+    if has_request_context() and '_statement_timeout' in g:
+        connection.execute(text('SET LOCAL statement_timeout = :timeout'),
+                           timeout=int(g._statement_timeout * 1000))
+
+
+def _is_statement_timeout(error):
+    return getattr(error.orig, 'pgcode', None) == QUERY_CANCELED
+
+
 # uniform response formatting:
 # {"data": <jsonified route result>}
 # or {"errors": <errors>} on ClientError
-def api_route(url, *args, **kwargs):
+def api_route(url, *args, versioned_by=None, version_interval=None, statement_timeout=None, **kwargs):
+    """Registers an API route, assembling the response from whatever f returns
+
+    versioned_by: names of the tables GET responses depend on (see db.odie.VERSIONED_TABLES). If given, GET
+            responses get an ETag and a Last-Modified header and conditional requests are answered with 304 before
+            calling f at all.
+    version_interval: for responses which also depend on the current time, the number of seconds after which
+            they are considered modified anyway
+    statement_timeout: time budget in seconds for each SQL statement of a request. Defaults to f's own
+            statement_timeout attribute (see endpoint()) or config.DEFAULT_STATEMENT_TIMEOUT. Timeouts are answered
+            with 503. Streamed responses can only be cut off once they've started.
+    """
     def decorator(f):
+        timeout = statement_timeout or getattr(f, 'statement_timeout', None) or config.DEFAULT_STATEMENT_TIMEOUT
+
         @wraps(f)
         @handle_client_errors
         def wrapped_f(*f_args, **f_kwargs):
-            data = f(*f_args, **f_kwargs)
-            if isinstance(data, PaginatedResult):
-                return jsonify(serialize(data, PaginatedResultSchema))
-            return jsonify(data=data)
-        return Flask.route(app, url, *args, **kwargs)(wrapped_f)
+            g._statement_timeout = timeout
+            try:
+                return _api_response(f, f_args, f_kwargs, versioned_by, version_interval)
+            except OperationalError as e:
+                if not _is_statement_timeout(e):
+                    raise
+                sqla.session.rollback()
+                metrics.incr('statement_timeouts', route_name())
+                raise ClientError('query timed out', status=503)
+
+        @wraps(f)
+        def timed_f(*f_args, **f_kwargs):
+            timer = timing.current()
+            response = app.make_response(wrapped_f(*f_args, **f_kwargs))
+            _report_timing(response, timer)
+            return response
+        return Flask.route(app, url, *args, **kwargs)(timed_f)
     return decorator
 
+
+def _report_timing(response, timer, on_close=True):
+    """Adds the Server-Timing header and logs slow requests once the response is sent (or right away)"""
+    response.headers['Server-Timing'] = timer.header()
+    user = get_user()
+    details = {
+        'route': route_name(),
+        'path': request.path,
+        'args': request.args.to_dict(flat=False),
+        'status': response.status_code,
+        'user': user.id if user else None,
+    }
+    if on_close:
+        response.call_on_close(lambda: timing.log_if_slow(timer, **details))
+    else:
+        timing.log_if_slow(timer, **details)
+
+
+def _api_response(f, f_args, f_kwargs, versioned_by, version_interval):
+    validators = None
+    if versioned_by is not None and request.method == 'GET':
+        validators = _validators(versioned_by, version_interval)
+        etag = _not_modified(*validators)
+        if etag is not None:
+            response = Response(status=304)
+            _set_validators(response, etag, validators[1])
+            return response
+    data = f(*f_args, **f_kwargs)
+    encoded = None
+    if isinstance(data, EncodedJSON):
+        response = Response(data.body, mimetype='application/json')
+        encoded = data
+    elif isinstance(data, StreamedResult):
+        response = data.response()
+    elif isinstance(data, PaginatedResult):
+        response = jsonify(serialize(data, PaginatedResultSchema))
+    else:
+        response = jsonify(data=data)
+    response = app.make_response(response)  # jsonify() may return plain HTML
+    if validators is not None:
+        _set_validators(response, *validators)
+    _encode_response(response, encoded)
+    return response
+
+
+def _set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # clients may keep responses, but have to revalidate them every time
+    response.cache_control.no_cache = True
+    response.vary.update(('Accept', 'Accept-Encoding', 'Cookie', 'Authorization'))
+
 ROUTE_ID = 0
 
 
-def endpoint(query_fn, schemas=None, allow_delete=False, paginate_many=True, allow_insecure_authenticated=False):
+def endpoint(query_fn, schemas=None, allow_delete=False, paginate_many=True, allow_insecure_authenticated=False,
+             sort_columns=(), count='exact', stream_many=False, statement_timeout=None):
     """Creates and returns an API endpoint handler
 
     Can create both SINGLE-style and MANY-style endpoints. The generated route simply
@@ -158,7 +920,19 @@ def endpoint(query_fn, schemas=None, allow_delete=False, paginate_many=True, all
             These keys also define permissible methods.
     query_fn: A callable returning a Query object. Mustn't be None for GET-enabled endpoints.
     paginate_many: whether to return paginated results (default:True)
-            The 'page' GET-parameter selects the page
+            The 'page' key of the 'q' GET-parameter selects the page. Alternatively, its 'cursor' key switches to
+            cursor-based pagination (see KeysetPagination).
+    stream_many: whether to stream unpaginated results (see StreamedResult) instead of serializing them all at once
+            Clients may restrict the serialized fields of GET MANY requests with the 'fields' parameter (see
+            _sparse_query()).
+    statement_timeout: time budget in seconds for each SQL statement, picked up by api_route
+    sort_columns: columns which anonymous users may order the results by (see documents_query() for how this
+            has to be whitelisted by query_fn, too). Only used for cursor-based pagination.
+    count: how the total number of results is determined for page-based pagination. Can be overridden by the
+            'count' GET-parameter.
+            'exact': count(*) on every request
+            'estimated': count(*) once, then cached until one of the queried tables is written to
+            'none': no total (and no number_of_pages) at all
     allow_insecure_authenticated: If true, the 'q' parameter (JSON) will be parsed into an SQLAlchemy Query using the
                                   jsonquery library if the user is logged in. If the user is not logged in, this feature
                                   will stay disabled.
@@ -178,8 +952,15 @@ def endpoint(query_fn, schemas=None, allow_delete=False, paginate_many=True, all
         if instance_id is None:  # GET MANY
             assert 'GET' in schemas, "GET schema missing"
             schema = schemas['GET']
+            query = query_fn()
+            only = _requested_fields(schema)
+            if only is not None:
+                query = _sparse_query(query, schema, only)
+                schema = partial(schema, only=only)
             allow_insecure = allow_insecure_authenticated and get_user()
-            return filtered_results(query_fn(), schema, paginate_many, allow_insecure=allow_insecure)
+            with timing.phase('query'):
+                return filtered_results(query, schema, paginate_many, allow_insecure=allow_insecure,
+                                        sort_columns=sort_columns, count=count, stream=stream_many)
         else:  # GET SINGLE
             result = query_fn().get(instance_id)
             obj = serialize(result, schema)
@@ -213,6 +994,7 @@ def endpoint(query_fn, schemas=None, allow_delete=False, paginate_many=True, all
     global ROUTE_ID
     handle_generic.__name__ = '__generated_' + str(ROUTE_ID)
     ROUTE_ID += 1
+    handle_generic.statement_timeout = statement_timeout
     return handle_generic
 
 
@@ -256,7 +1038,11 @@ def event_stream(f):
             except Exception as e:
                 yield 'event: stream-error\ndata: internal server error: ' + str(e) + '  traceback: ' + str(traceback.print_exc()) + '\n\n'
                 app.logger.exception(e)
+        timer = timing.current()
         stream = get_stream()
         next(stream)  # skip first datum
-        return Response(stream, mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+        response = Response(stream, mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+        # events may take forever, only the setup is timed
+        _report_timing(response, timer, on_close=False)
+        return response
     return wrapped
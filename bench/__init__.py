@@ -0,0 +1,24 @@
+#! /usr/bin/env python3
+
+# Benchmarks for odie. Like the tests, they reset and refill the local databases, so never run them in production.
+# Run them from the repository root, e.g. `python3 -m bench.api --output before.json`.
+
+import math
+
+from test.harness import OdieTestCase
+from scripts import fill_data
+
+
+def setup_database():
+    """Resets the databases to the sample data and returns a fresh test client"""
+    OdieTestCase.setUpClass()
+    OdieTestCase.clear_all()
+    fill_data.fill()
+    return OdieTestCase.app
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list of numbers"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
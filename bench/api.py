@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+
+"""Measures latency, SQL statements and response size of the HTTP API
+
+Every benchmark issues `--iterations` requests (after a few warm-up requests) through the Flask test client against
+the sample data, and reports the p50/p95/p99 latency and the SQL statements and bytes per request. With `--output`
+the results are written as JSON; with `--baseline` they're compared against such a file, and the run fails if a
+benchmark got slower by more than `--tolerance` or executes more statements than before.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from bench import setup_database, percentile
+
+import routes  # pylint: disable=unused-import
+from odie import app
+
+USERNAME = 'guybrush'
+PASSWORD = 'arrrrr'
+PDF_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'test', 'upload.pdf')
+
+SUBMISSION_JSON = json.dumps({
+        'lectures': ['Fortgeschrittenes Nichtstun'],
+        'department': 'computer science',
+        'examinants': ['Anon Ymous'],
+        'date': '2010-01-01',
+        'document_type': 'oral',
+        'student_name': 'benchmark',
+    }, separators=(',', ':'))
+
+
+def q(**params):
+    return json.dumps(params, separators=(',', ':'))
+
+
+# what the documentselection view sends
+DOCUMENT_SELECTION_Q = q(operator='order_by_desc', column='date', page=1, value={
+        'operator': 'and',
+        'value': [{'column': 'document_type', 'operator': 'in_', 'value': ['written', 'oral', 'oral reexam', 'mock exam']}],
+    })
+
+
+class Clients(object):
+    def __init__(self):
+        self.anonymous = app.test_client()
+        self.authenticated = app.test_client()
+        self.authenticated.post('/login?target_path=/', data={'username': USERNAME, 'password': PASSWORD})
+        assert self.authenticated.get('/api/user_info').status_code == 200, 'login failed'
+
+    def view_url(self):
+        """URL of a document that has a file (submitting one first, since the sample data comes without files)"""
+        submit_document(self.anonymous)
+        res = self.authenticated.get('/api/documents?q=' + q(operator='order_by_desc', column='id',
+                value={'operator': '==', 'column': 'has_file', 'value': True}))
+        return '/api/view/%d' % json.loads(res.data.decode('utf-8'))['data'][0]['id']
+
+
+def get(url):
+    return lambda client: client.get(url)
+
+
+def submit_document(client):
+    with open(PDF_PATH, 'rb') as pdf:
+        return client.post('/api/documents', data={'json': SUBMISSION_JSON, 'file': pdf})
+
+
+def benchmarks(clients):
+    """Returns (name, client, fn) triples, fn issuing a request with client and returning the response"""
+    view_url = clients.view_url()
+    (anonymous, authenticated) = (clients.anonymous, clients.authenticated)
+    return [
+        ('documents (anonymous)', anonymous, get('/api/documents')),
+        ('documents (anonymous, documentselection)', anonymous, get('/api/documents?q=' + DOCUMENT_SELECTION_Q)),
+        ('documents (anonymous, lecture filter)', anonymous,
+            get('/api/documents?filters=' + q(includes_lectures=[1, 2]))),
+        ('documents (authenticated)', authenticated, get('/api/documents')),
+        ('documents (authenticated, jsonquery filter and sort)', authenticated, get('/api/documents?q=' + q(
+            operator='order_by_asc', column='number_of_pages',
+            value={'operator': '==', 'column': 'department', 'value': 'computer science'}))),
+        ('documents (authenticated, sparse fields)', authenticated, get('/api/documents?fields=id,date,lectures')),
+        ('lectures', anonymous, get('/api/lectures')),
+        ('examinants', anonymous, get('/api/examinants')),
+        ('orders', authenticated, get('/api/orders')),
+        ('deposits', authenticated, get('/api/deposits')),
+        ('document submission', anonymous, submit_document),
+        ('view', authenticated, get(view_url)),
+    ]
+
+
+def run(client, fn, iterations, warmup):
+    for _ in range(warmup):
+        fn(client)
+    latencies = []
+    statements = []
+    sizes = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        res = fn(client)
+        latencies.append(time.perf_counter() - start)
+        assert res.status_code == 200, 'request failed with status {}'.format(res.status_code)
+        statements.append(len(client.last_statements))
+        sizes.append(len(res.data))
+    return {
+        'requests': iterations,
+        'p50_ms': round(1000 * percentile(latencies, 50), 2),
+        'p95_ms': round(1000 * percentile(latencies, 95), 2),
+        'p99_ms': round(1000 * percentile(latencies, 99), 2),
+        'statements': max(statements),
+        'bytes': percentile(sizes, 50),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints the differences to `baseline` and returns the names of the benchmarks that regressed"""
+    regressed = []
+    for (name, result) in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        slower = result['p50_ms'] > before['p50_ms'] * (1 + tolerance) or \
+            result['p95_ms'] > before['p95_ms'] * (1 + tolerance)
+        more_statements = result['statements'] > before['statements']
+        print('{}: p50 {:+.1f}%, p95 {:+.1f}%, statements {:+d}, bytes {:+d}{}'.format(
+            name,
+            100 * (result['p50_ms'] / before['p50_ms'] - 1),
+            100 * (result['p95_ms'] / before['p95_ms'] - 1),
+            result['statements'] - before['statements'],
+            result['bytes'] - before['bytes'],
+            '  <- REGRESSION' if slower or more_statements else ''))
+        if slower or more_statements:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--only', help='only run benchmarks whose name contains this')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results to this JSON file (as written by --output)')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='how much slower than the baseline a benchmark may get (default: 20%%)')
+    args = parser.parse_args()
+
+    setup_database()
+    clients = Clients()
+
+    results = {}
+    for (name, client, fn) in benchmarks(clients):
+        if args.only and args.only not in name:
+            continue
+        results[name] = result = run(client, fn, args.iterations, args.warmup)
+        print('{}: p50 {p50_ms:.1f} ms, p95 {p95_ms:.1f} ms, p99 {p99_ms:.1f} ms, '
+              '{statements} statements, {bytes} bytes'.format(name, **result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        regressed = compare(results, baseline, args.tolerance)
+        if regressed:
+            print('\n{} benchmark(s) regressed'.format(len(regressed)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
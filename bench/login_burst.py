@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+
+"""Measures login throughput and catalog latency during a concurrent burst of logins
+
+Before the burst, the latency of /api/lectures is sampled on an otherwise idle server. Then `--logins` logins are
+fired from `--concurrency` threads while another thread keeps requesting /api/lectures.
+"""
+
+import argparse
+import threading
+import time
+
+from bench import setup_database, percentile
+
+import routes  # pylint: disable=unused-import
+from odie import app
+
+USERNAME = 'guybrush'
+PASSWORD = 'arrrrr'
+
+
+def sample_catalog(client, stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        client.get('/api/lectures')
+        latencies.append(time.perf_counter() - start)
+
+
+def login_worker(count, statuses):
+    client = app.test_client()
+    for _ in range(count):
+        res = client.post('/login?target_path=/', data={'username': USERNAME, 'password': PASSWORD})
+        statuses.append(res.status_code)
+
+
+def summarize(name, latencies):
+    print('{}: {} requests, p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+        name, len(latencies), *(1000 * percentile(latencies, p) for p in (50, 95, 99))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--idle-samples', type=int, default=100)
+    args = parser.parse_args()
+
+    setup_database()
+    client = app.test_client()
+
+    idle = []
+    for _ in range(args.idle_samples):
+        start = time.perf_counter()
+        client.get('/api/lectures')
+        idle.append(time.perf_counter() - start)
+
+    stop = threading.Event()
+    busy = []
+    sampler = threading.Thread(target=sample_catalog, args=(client, stop, busy))
+    statuses = []
+    workers = [threading.Thread(target=login_worker, args=(args.logins // args.concurrency, statuses))
+               for _ in range(args.concurrency)]
+
+    sampler.start()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+
+    succeeded = sum(1 for status in statuses if status == 302)
+    rejected = sum(1 for status in statuses if status == 503)
+    print('logins: {} in {:.2f} s ({:.1f}/s), {} succeeded, {} rejected with 503'.format(
+        len(statuses), elapsed, len(statuses) / elapsed, succeeded, rejected))
+    summarize('/api/lectures (idle)', idle)
+    summarize('/api/lectures (during burst)', busy)
+
+
+if __name__ == '__main__':
+    main()
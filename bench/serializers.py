@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+
+"""Compares marshmallow's generic dump() with the precompiled serializers on in-memory documents
+
+The documents are never added to a session, so this needs neither a database nor any sample data. Both code paths
+have to produce identical output, otherwise the benchmark fails.
+"""
+
+import argparse
+import datetime
+import time
+
+from flask import g
+
+import routes  # pylint: disable=unused-import
+from odie import app
+from api_utils import serialize
+from db.documents import Document, Examinant, Lecture
+from login import SessionUser
+from routes.common import DocumentDumpSchema
+
+
+def make_documents(count):
+    lectures = [Lecture(id=i, name='Lecture {}'.format(i)) for i in range(50)]
+    examinants = [Examinant(id=i, name='Examinant {}'.format(i)) for i in range(30)]
+    documents = []
+    for i in range(count):
+        validated = i % 3 != 0
+        documents.append(Document(
+                id=i,
+                department='computer science' if i % 2 else 'mathematics',
+                date=datetime.date(2010, 1, 1) + datetime.timedelta(days=i % 3000),
+                number_of_pages=i % 40,
+                solution='official' if i % 4 else None,
+                comment='',
+                document_type='oral' if i % 5 else 'written',
+                has_file=i % 7 != 0,
+                publicly_available=i % 2 == 0,
+                validation_time=datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc) if validated else None,
+                submitted_by='guybrush' if i % 3 else None,
+                early_document_eligible=i % 11 == 0,
+                deposit_return_eligible=i % 13 == 0,
+                lectures=[lectures[i % 50], lectures[(i * 7) % 50]],
+                examinants=[examinants[i % 30]]))
+    return documents
+
+
+def measure(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def compare(name, documents, repeat):
+    generic_time, generic = measure(lambda: DocumentDumpSchema().dump(documents, many=True), repeat)
+    compiled_time, compiled = measure(lambda: serialize(documents, DocumentDumpSchema, many=True), repeat)
+    assert generic == compiled, 'precompiled serializer output differs from marshmallow'
+    print('{}: marshmallow {:.1f} ms, precompiled {:.1f} ms ({:.1f}x)'.format(
+        name, 1000 * generic_time, 1000 * compiled_time, generic_time / compiled_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--documents', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    documents = make_documents(args.documents)
+    with app.test_request_context():
+        g._user = None
+        compare('anonymous', documents, args.repeat)
+    with app.test_request_context():
+        g._user = SessionUser(1, 'guybrush', 'Guybrush', 'Threepwood', 0)
+        compare('authenticated', documents, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
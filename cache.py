@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+
+import collections
+import threading
+import time
+
+import metrics
+
+
+class LRUCache(object):
+    """Thread-safe, process-local LRU cache with an optional time to live for its entries
+
+    If max_bytes is given, the sizes passed to put() mustn't add up to more than that, either.
+    Hits, misses and evictions are counted in the metrics group `name`.
+    """
+
+    def __init__(self, name, max_entries, ttl=None, max_bytes=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires, _ = entry
+                if expires is None or time.monotonic() < expires:
+                    self._entries.move_to_end(key)
+                    metrics.incr(self.name, 'hits')
+                    return value
+                self._remove(key)
+        metrics.incr(self.name, 'misses')
+        return default
+
+    def put(self, key, value, size=0):
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                metrics.incr(self.name, 'evictions')
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def evict(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def evict_where(self, predicate):
+        """Evicts all entries for whose value `predicate` returns True"""
+        with self._lock:
+            for key in [key for key, (value, _, _) in self._entries.items() if predicate(value)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -1,6 +1,7 @@
 #! /usr/bin/env python3
 
 import config
+import datetime
 
 from odie import sqla, Column
 
@@ -16,3 +17,43 @@ effective_permissions = sqla.Table('effektive_benutzer_rechte',
         Column('benutzer_id', sqla.Integer, sqla.ForeignKey('public.benutzer.benutzer_id')),
         Column('rechteid', sqla.Integer, sqla.ForeignKey('acl.rechte.rechteid')),
         **config.acl_table_args)
+
+
+# Permission checks are done on integer bitmasks. The permission ids from acl.rechte serve as bit positions,
+# so masks compiled by different worker processes are interchangeable.
+_permission_bits = {}
+_mask_cache = {}
+_last_load = None
+_RELOAD_INTERVAL = datetime.timedelta(minutes=1)
+
+
+def _load_permission_bits():
+    global _permission_bits, _mask_cache, _last_load
+    _permission_bits = {name: 1 << id for (id, name) in sqla.session.query(Permission.id, Permission.name)}
+    _mask_cache = {}
+    _last_load = datetime.datetime.now()
+
+
+def compile_permissions(permissions):
+    """Returns the bitmask of a collection of Permission objects"""
+    mask = 0
+    for perm in permissions:
+        mask |= 1 << perm.id
+    return mask
+
+
+def permission_mask(*perm_names):
+    """Returns the bitmask of the given permission names. Unknown permissions don't set any bits."""
+    mask = _mask_cache.get(perm_names)
+    if mask is None:
+        known = all(name in _permission_bits for name in perm_names)
+        if _last_load is None or not known and datetime.datetime.now() - _last_load > _RELOAD_INTERVAL:
+            _load_permission_bits()
+            known = all(name in _permission_bits for name in perm_names)
+        mask = 0
+        for name in perm_names:
+            mask |= _permission_bits.get(name, 0)
+        if known:
+            # masks including unknown permissions are recomputed once the next reload is due
+            _mask_cache[perm_names] = mask
+    return mask
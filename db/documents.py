@@ -82,6 +82,9 @@ REVOKE ALL ON FUNCTION documents.lectures_early_document_reward_until(int, int,
         # This is due to id getting set to null in some cases (ie loading a document without lectures), which correctly raises an exception
     )
 
+    # the aliases as a single string, which (unlike the array) can have a trigram index, see SEARCH_INDEX_CALLS
+    aliases_text = column_property(func.documents.lecture_aliases_text(aliases, type_=sqla.String), deferred=True)
+
     @property
     def early_document_eligible(self):
         until = self.early_document_until
@@ -104,9 +107,10 @@ folder_docs = sqla.Table('folder_docs',
         **config.documents_table_args)
 
 
-# Note that if you extend this enum, make sure to adjust the validation in routes/documents.py's documents_query()
-# accordingly.
+# Note that if you extend this enum, make sure to adjust routes/documents.py's DOCUMENT_TYPES (used to validate
+# anonymous queries) accordingly.
 document_type = sqla.Enum('oral', 'written', 'oral reexam', 'mock exam', name='document_type', inherit_schema=True)
+department = sqla.Enum('mathematics', 'computer science', 'other', name='department', inherit_schema=True)
 
 
 class Document(sqla.Model):
@@ -114,7 +118,7 @@ class Document(sqla.Model):
     __table_args__ = config.documents_table_args
 
     id = Column(sqla.Integer, primary_key=True)
-    department = Column(sqla.Enum('mathematics', 'computer science', 'other', name='department', inherit_schema=True))
+    department = Column(department)
     date = Column(sqla.Date())
     number_of_pages = Column(sqla.Integer, server_default='0')
     solution = Column(sqla.Enum('official', 'inofficial', 'none', name='solution', inherit_schema=True), nullable=True)
@@ -172,6 +176,180 @@ class Examinant(sqla.Model):
         return self.name
 
 
+# Number of documents per (lecture, document type, department) and (examinant, document type), kept up to date by
+# the triggers in FACET_STORED_PROCEDURE_CALLS on every write to documents, lecture_docs and document_examinants.
+# Documents without a type or department aren't counted.
+lecture_facets = sqla.Table('lecture_facets',
+        Column('lecture_id', sqla.Integer, sqla.ForeignKey('documents.lectures.id', ondelete='CASCADE'), primary_key=True),
+        Column('document_type', document_type, primary_key=True),
+        Column('department', department, primary_key=True),
+        Column('count', sqla.Integer, nullable=False),
+        **config.documents_table_args)
+
+examinant_facets = sqla.Table('examinant_facets',
+        Column('examinant_id', sqla.Integer, sqla.ForeignKey('documents.examinants.id', ondelete='CASCADE'), primary_key=True),
+        Column('document_type', document_type, primary_key=True),
+        Column('count', sqla.Integer, nullable=False),
+        **config.documents_table_args)
+
+
+def _facets(table, owner_clause, *columns):
+    """Deferred column property with the facets of a lecture/examinant as a JSON list, loaded in the same query"""
+    entry = func.json_build_object(*(arg for column in columns + (table.c['count'],) for arg in (column.name, column)))
+    return column_property(
+        select([func.coalesce(func.json_agg(postgresql.aggregate_order_by(entry, *columns)), '[]',
+                              type_=postgresql.JSON)])
+        .where(owner_clause)
+        .correlate_except(table),
+        deferred=True)
+
+
+Lecture.facets = _facets(lecture_facets, lecture_facets.c.lecture_id == Lecture.id,
+                         lecture_facets.c.document_type, lecture_facets.c.department)
+Examinant.facets = _facets(examinant_facets, examinant_facets.c.examinant_id == Examinant.id,
+                           examinant_facets.c.document_type)
+
+
+FACET_STORED_PROCEDURE_CALLS = [sqla.text("""
+CREATE OR REPLACE FUNCTION documents.bump_lecture_facet(lec_id int, doc_type documents.document_type,
+		dep documents.department, delta int) RETURNS void AS $$
+BEGIN
+	IF doc_type IS NULL OR dep IS NULL THEN
+		RETURN;
+	END IF;
+	IF delta > 0 THEN
+		INSERT INTO lecture_facets (lecture_id, document_type, department, count) VALUES (lec_id, doc_type, dep, delta)
+		ON CONFLICT (lecture_id, document_type, department) DO UPDATE SET count = lecture_facets.count + EXCLUDED.count;
+	ELSE
+		-- never inserts: the lecture may be in the middle of being deleted
+		UPDATE lecture_facets SET count = count + delta
+		WHERE lecture_id = lec_id AND document_type = doc_type AND department = dep;
+		DELETE FROM lecture_facets WHERE lecture_id = lec_id AND document_type = doc_type AND department = dep AND count <= 0;
+	END IF;
+END
+$$ LANGUAGE plpgsql SET search_path = documents, pg_temp;
+"""), sqla.text("""
+CREATE OR REPLACE FUNCTION documents.bump_examinant_facet(ex_id int, doc_type documents.document_type, delta int)
+		RETURNS void AS $$
+BEGIN
+	IF doc_type IS NULL THEN
+		RETURN;
+	END IF;
+	IF delta > 0 THEN
+		INSERT INTO examinant_facets (examinant_id, document_type, count) VALUES (ex_id, doc_type, delta)
+		ON CONFLICT (examinant_id, document_type) DO UPDATE SET count = examinant_facets.count + EXCLUDED.count;
+	ELSE
+		UPDATE examinant_facets SET count = count + delta WHERE examinant_id = ex_id AND document_type = doc_type;
+		DELETE FROM examinant_facets WHERE examinant_id = ex_id AND document_type = doc_type AND count <= 0;
+	END IF;
+END
+$$ LANGUAGE plpgsql SET search_path = documents, pg_temp;
+"""), sqla.text("""
+CREATE OR REPLACE FUNCTION documents.lecture_docs_facets() RETURNS trigger AS $$
+BEGIN
+	-- links deleted by the cascade from a deleted document don't find it anymore, see documents_facets()
+	IF TG_OP IN ('DELETE', 'UPDATE') THEN
+		PERFORM bump_lecture_facet(OLD.lecture_id, doc.document_type, doc.department, -1)
+		FROM documents AS doc WHERE doc.id = OLD.document_id;
+	END IF;
+	IF TG_OP IN ('INSERT', 'UPDATE') THEN
+		PERFORM bump_lecture_facet(NEW.lecture_id, doc.document_type, doc.department, 1)
+		FROM documents AS doc WHERE doc.id = NEW.document_id;
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = documents, pg_temp;
+"""), sqla.text("""
+CREATE OR REPLACE FUNCTION documents.document_examinants_facets() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP IN ('DELETE', 'UPDATE') THEN
+		PERFORM bump_examinant_facet(OLD.examinant_id, doc.document_type, -1)
+		FROM documents AS doc WHERE doc.id = OLD.document_id;
+	END IF;
+	IF TG_OP IN ('INSERT', 'UPDATE') THEN
+		PERFORM bump_examinant_facet(NEW.examinant_id, doc.document_type, 1)
+		FROM documents AS doc WHERE doc.id = NEW.document_id;
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = documents, pg_temp;
+"""), sqla.text("""
+CREATE OR REPLACE FUNCTION documents.documents_facets() RETURNS trigger AS $$
+BEGIN
+	-- runs BEFORE DELETE, while the document's links still exist
+	IF TG_OP = 'DELETE' OR OLD.document_type IS DISTINCT FROM NEW.document_type
+			OR OLD.department IS DISTINCT FROM NEW.department THEN
+		PERFORM bump_lecture_facet(link.lecture_id, OLD.document_type, OLD.department, -1)
+		FROM lecture_docs AS link WHERE link.document_id = OLD.id;
+		PERFORM bump_examinant_facet(link.examinant_id, OLD.document_type, -1)
+		FROM document_examinants AS link WHERE link.document_id = OLD.id;
+	END IF;
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+	IF OLD.document_type IS DISTINCT FROM NEW.document_type OR OLD.department IS DISTINCT FROM NEW.department THEN
+		PERFORM bump_lecture_facet(link.lecture_id, NEW.document_type, NEW.department, 1)
+		FROM lecture_docs AS link WHERE link.document_id = NEW.id;
+		PERFORM bump_examinant_facet(link.examinant_id, NEW.document_type, 1)
+		FROM document_examinants AS link WHERE link.document_id = NEW.id;
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = documents, pg_temp;
+"""), sqla.text("""
+REVOKE ALL ON FUNCTION documents.bump_lecture_facet(int, documents.document_type, documents.department, int) FROM PUBLIC;
+REVOKE ALL ON FUNCTION documents.bump_examinant_facet(int, documents.document_type, int) FROM PUBLIC;
+"""), sqla.text("""
+DROP TRIGGER IF EXISTS facets ON documents.lecture_docs;
+CREATE TRIGGER facets AFTER INSERT OR UPDATE OR DELETE ON documents.lecture_docs
+FOR EACH ROW EXECUTE PROCEDURE documents.lecture_docs_facets();
+DROP TRIGGER IF EXISTS facets ON documents.document_examinants;
+CREATE TRIGGER facets AFTER INSERT OR UPDATE OR DELETE ON documents.document_examinants
+FOR EACH ROW EXECUTE PROCEDURE documents.document_examinants_facets();
+DROP TRIGGER IF EXISTS facets_delete ON documents.documents;
+CREATE TRIGGER facets_delete BEFORE DELETE ON documents.documents
+FOR EACH ROW EXECUTE PROCEDURE documents.documents_facets();
+DROP TRIGGER IF EXISTS facets_update ON documents.documents;
+CREATE TRIGGER facets_update AFTER UPDATE OF document_type, department ON documents.documents
+FOR EACH ROW EXECUTE PROCEDURE documents.documents_facets();
+""")]
+
+# recounts the facets from scratch, e.g. after bulk loads with the facet triggers disabled
+FACET_BACKFILL = sqla.text("""
+DELETE FROM documents.lecture_facets;
+INSERT INTO documents.lecture_facets (lecture_id, document_type, department, count)
+SELECT link.lecture_id, doc.document_type, doc.department, count(*)
+FROM documents.lecture_docs AS link
+JOIN documents.documents AS doc ON doc.id = link.document_id
+WHERE doc.document_type IS NOT NULL AND doc.department IS NOT NULL
+GROUP BY link.lecture_id, doc.document_type, doc.department;
+DELETE FROM documents.examinant_facets;
+INSERT INTO documents.examinant_facets (examinant_id, document_type, count)
+SELECT link.examinant_id, doc.document_type, count(*)
+FROM documents.document_examinants AS link
+JOIN documents.documents AS doc ON doc.id = link.document_id
+WHERE doc.document_type IS NOT NULL
+GROUP BY link.examinant_id, doc.document_type;
+""")
+
+
+# Trigram indexes answering ILIKE '%term%' on lecture names and aliases and examinant names, for the typeahead
+# search routes and the admin search boxes. Created by scripts/create_garfield_models.py, see also
+# scripts/migrate_search_indexes.sql.
+SEARCH_INDEX_CALLS = [sqla.text("""
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+"""), sqla.text("""
+CREATE OR REPLACE FUNCTION documents.lecture_aliases_text(aliases varchar[]) RETURNS text AS $$
+	SELECT array_to_string(aliases, ' ');
+$$ LANGUAGE sql IMMUTABLE;
+"""), sqla.text("""
+CREATE INDEX IF NOT EXISTS lectures_name_trgm ON documents.lectures USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS lectures_aliases_trgm ON documents.lectures
+	USING gin (documents.lecture_aliases_text(aliases) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS examinants_name_trgm ON documents.examinants USING gin (name gin_trgm_ops);
+""")]
+
+
 class Folder(sqla.Model):
     __tablename__ = 'folders'
     __table_args__ = config.documents_table_args
@@ -1,12 +1,18 @@
 #! /usr/bin/env python3
 
+import atexit
+import concurrent.futures
 import crypt
+import multiprocessing
+import threading
+import time
 
 import config
 import datetime
+import metrics
 import db.acl as acl
 
-from odie import sqla, Column
+from odie import app, sqla, Column
 from sqlalchemy.sql import column
 
 
@@ -23,14 +29,65 @@ class Cookie(sqla.Model):
     last_action = Column(sqla.DateTime, primary_key=True)
     lifetime = Column(sqla.Integer)
 
-    def refresh(self):
-        if not config.LOCAL_SERVER:
-            # we can't use an SQL expression for this, because then sqlalchemy will try to fetch the
-            # result of that with a RETURNING clause, which doesn't work on this view.
-            # If we inform sqlalchemy of all values of the mapped instance by keeping them inside python,
-            # it's fine though
-            now = datetime.datetime.now()
-            sqla.session.add(Cookie(sid=self.sid, user_id=self.user_id, last_action=now, lifetime=self.lifetime))
+
+# Every refresh is an INSERT into the cookies view, so doing it on every authenticated request would turn
+# each read-only GET into a write against the fsmi database. Instead, sessions are only refreshed once
+# their last action is older than SESSION_REFRESH_INTERVAL, and the refreshes are written behind (one per sid)
+# by a background thread.
+_pending_refreshes = {}
+_pending_lock = threading.Lock()
+_flush_thread = None
+
+
+def refresh_session(sid, user_id, last_action, lifetime):
+    """Schedules a refresh of the session if necessary and returns its (new) time of last action"""
+    global _flush_thread
+    if config.LOCAL_SERVER:
+        return last_action
+    now = datetime.datetime.now()
+    if now - last_action < datetime.timedelta(seconds=config.SESSION_REFRESH_INTERVAL):
+        metrics.incr('session_refresh', 'skipped')
+        return last_action
+    with _pending_lock:
+        metrics.incr('session_refresh', 'coalesced' if sid in _pending_refreshes else 'queued')
+        _pending_refreshes[sid] = (user_id, now, lifetime)
+        if _flush_thread is None:
+            _flush_thread = threading.Thread(target=_flush_periodically, name='cookie-refresh', daemon=True)
+            _flush_thread.start()
+    return now
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(config.SESSION_REFRESH_FLUSH_INTERVAL)
+        flush_refreshes()
+
+
+def flush_refreshes():
+    with _pending_lock:
+        pending = list(_pending_refreshes.items())
+        _pending_refreshes.clear()
+    batch_size = config.SESSION_REFRESH_BATCH_SIZE
+    with app.app_context():
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            try:
+                # we can't use an SQL expression for last_action, because then sqlalchemy will try to fetch the
+                # result of that with a RETURNING clause, which doesn't work on this view.
+                # If we inform sqlalchemy of all values of the mapped instances by keeping them inside python,
+                # it's fine though
+                sqla.session.add_all(Cookie(sid=sid, user_id=user_id, last_action=last_action, lifetime=lifetime)
+                                     for (sid, (user_id, last_action, lifetime)) in batch)
+                sqla.session.commit()
+                metrics.incr('session_refresh', 'written', len(batch))
+            except Exception as e:
+                # a lost refresh only means the session might expire a bit early
+                sqla.session.rollback()
+                metrics.incr('session_refresh', 'failed', len(batch))
+                app.logger.exception(e)
+        sqla.session.remove()
+
+atexit.register(flush_refreshes)
 
 
 class User(sqla.Model):
@@ -49,8 +106,15 @@ class User(sqla.Model):
     def full_name(self):
         return self.first_name + ' ' + self.last_name
 
+    @property
+    def permission_mask(self):
+        # compiled on first use, after effective_permissions has been (eagerly) loaded
+        if not hasattr(self, '_permission_mask'):
+            self._permission_mask = acl.compile_permissions(self.effective_permissions)
+        return self._permission_mask
+
     def has_permission(self, *perm_names):
-        return any(perm.name in perm_names for perm in self.effective_permissions)
+        return bool(self.permission_mask & acl.permission_mask(*perm_names))
 
     @staticmethod
     def authenticate(username, password):
@@ -58,7 +122,44 @@ class User(sqla.Model):
         if not user:
             return None
         if user.has_permission('homepage_login') and\
-           crypt.crypt(password, user.pw_hash) == user.pw_hash:
+           _verify_password(password, user.pw_hash):
             return user
         else:
             return None
+
+
+# crypt() is CPU-bound and holds the GIL, so a burst of logins (say, at the start of the semester) would starve the
+# threads serving everybody else. Passwords are therefore verified in a small process pool. Once
+# PASSWORD_POOL_MAX_PENDING verifications are pending, further logins are turned away instead of queueing up.
+_password_pool = None
+_password_pool_lock = threading.Lock()
+_password_slots = threading.BoundedSemaphore(config.PASSWORD_POOL_MAX_PENDING)
+
+
+def _verify_password(password, pw_hash):
+    from odie import ClientError
+    global _password_pool
+
+    if not _password_slots.acquire(blocking=False):
+        metrics.incr('password_pool', 'rejected')
+        raise ClientError('too many concurrent logins, try again later', status=503)
+    try:
+        with _password_pool_lock:
+            if _password_pool is None:
+                # forking a multithreaded WSGI process could copy locks held by other threads into the workers
+                _password_pool = concurrent.futures.ProcessPoolExecutor(
+                        config.PASSWORD_POOL_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+        future = _password_pool.submit(crypt.crypt, password, pw_hash)
+    except Exception:
+        _password_slots.release()
+        raise
+    # the slot is only given back once the verification has left the pool, so abandoned verifications still count
+    future.add_done_callback(lambda _: _password_slots.release())
+    try:
+        result = future.result(timeout=config.PASSWORD_POOL_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        future.cancel()  # only succeeds if it's still queued
+        metrics.incr('password_pool', 'timeouts')
+        raise ClientError('too many concurrent logins, try again later', status=503)
+    metrics.incr('password_pool', 'verified')
+    return result == pw_hash
@@ -36,3 +36,48 @@ class Order(sqla.Model):
     @property
     def documents(self):
         return [item.document for item in self.items]
+
+
+# Every write to one of these tables bumps its entry in odie.table_versions (by trigger, so this also
+# catches writes from outside odie). Caches use the versions to notice when they have become stale.
+VERSIONED_TABLES = [
+    'documents.documents',
+    'documents.lectures',
+    'documents.examinants',
+    'documents.lecture_docs',
+    'documents.document_examinants',
+    'documents.folders',
+    'documents.folder_docs',
+    'documents.folder_lectures',
+    'documents.folder_examinants',
+    'documents.deposits',
+    'documents.deposit_lectures',
+    'odie.orders',
+    'odie.order_documents',
+]
+
+
+class TableVersion(sqla.Model):
+    __tablename__ = 'table_versions'
+    __table_args__ = config.odie_table_args
+
+    table_name = Column(sqla.String, primary_key=True)
+    # id of the last transaction writing to the table. Unlike a counter, this never repeats, not even
+    # after the tables have been emptied.
+    version = Column(sqla.BigInteger)
+    changed_at = Column(sqla.DateTime(timezone=True))
+
+    stored_procedure_calls = [sqla.text("""
+CREATE OR REPLACE FUNCTION odie.bump_table_version() RETURNS trigger AS $$
+BEGIN
+	INSERT INTO odie.table_versions (table_name, version, changed_at)
+	VALUES (TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME, txid_current(), now())
+	ON CONFLICT (table_name) DO UPDATE SET version = EXCLUDED.version, changed_at = EXCLUDED.changed_at;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = odie, pg_temp;
+""")] + [sqla.text("""
+DROP TRIGGER IF EXISTS bump_table_version ON {0};
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {0}
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+""".format(table)) for table in VERSIONED_TABLES]
@@ -98,9 +98,59 @@ FS_CONFIG = {
 SUBMISSION_ALLOWED_FILE_EXTENSIONS = ['.pdf']
 LOCAL_SERVER = True
 ITEMS_PER_PAGE = 20
+# number of rows fetched and serialized at once by streamed endpoints
+STREAM_BATCH_SIZE = 500
+# cached totals for paginated results requested with count=estimated
+COUNT_CACHE_SIZE = 1024
+COUNT_CACHE_TTL = 60 * 60
+# seconds after which ETags of responses depending on the current time (like the early document eligibility of
+# lectures) change even if no table has been written to
+TIME_DEPENDENT_ETAG_INTERVAL = 5 * 60
+# serialized responses to anonymous /api/documents requests
+DOCUMENTS_CACHE_SIZE = 4096
+DOCUMENTS_CACHE_BYTES = 32 * 1024 * 1024
+# /api/documents/meta results, per filter
+DOCUMENTS_META_CACHE_SIZE = 1024
+# matches returned by /api/search/* by default and at most
+SEARCH_RESULTS = 10
+SEARCH_MAX_RESULTS = 50
+# smaller API responses aren't worth compressing
+COMPRESSION_MIN_SIZE = 1024
+# queries built from the jsonquery 'q' parameter are rejected if the planner estimates them to cost more than this
+# (in Postgres' planner cost units, see EXPLAIN). Estimates are cached per statement and parameters.
+JSONQUERY_MAX_COST = 25000
+QUERY_COST_CACHE_SIZE = 1024
+QUERY_COST_CACHE_TTL = 10 * 60
+# jsonquery criteria compiled with bound parameters, per entity and shape of the 'q' parameter
+JSONQUERY_TEMPLATE_CACHE_SIZE = 1024
+# seconds any single SQL statement of an API request may take (routes can declare their own budget)
+DEFAULT_STATEMENT_TIMEOUT = 10
+# ...and for routes accepting jsonquery filters
+JSONQUERY_STATEMENT_TIMEOUT = 5
+# maximum number of GET requests combined into one /api/batch request
+BATCH_MAX_REQUESTS = 10
+# API requests taking longer than this many seconds are written to the 'odie.slow_requests' log
+SLOW_REQUEST_THRESHOLD = 1.0
 DOCUMENT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'odie')
 ADMIN_PANEL_ALLOWED_GROUPS = ['fsusers']
 AUTH_COOKIE = 'FSMISESSID'
+# sessions are only refreshed if their last action is older than this (in seconds). Refreshes are
+# collected and written to the fsmi database in batches every SESSION_REFRESH_FLUSH_INTERVAL seconds.
+SESSION_REFRESH_INTERVAL = 60
+SESSION_REFRESH_FLUSH_INTERVAL = 5
+SESSION_REFRESH_BATCH_SIZE = 100
+# authenticated sessions are cached in-process for this long (in seconds) before they are looked up again
+SESSION_CACHE_TTL = 30
+SESSION_CACHE_SIZE = 1024
+# lifetime (in seconds) of the signed API tokens handed out by /api/user_info?api_token=1.
+# Change API_TOKEN_EPOCH to invalidate all tokens issued so far.
+API_TOKEN_LIFETIME = 15 * 60
+API_TOKEN_EPOCH = 0
+# password hashes are verified in a process pool of this size. Logins are rejected with a 503
+# once PASSWORD_POOL_MAX_PENDING of them are waiting or if one takes longer than PASSWORD_POOL_TIMEOUT seconds.
+PASSWORD_POOL_WORKERS = 2
+PASSWORD_POOL_MAX_PENDING = 16
+PASSWORD_POOL_TIMEOUT = 5
 
 PRINTER_USERCODES = {'internal': 3974}
 for cash_box in FS_CONFIG['OFFICES']['FSI']['cash_boxes']:
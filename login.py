@@ -1,28 +1,151 @@
 #! /usr/bin/env python3
 
+import config
+import datetime
+import hashlib
+import metrics
+import timing
+import db.acl as acl
+
 from functools import wraps
-from flask import request, session
+from flask import g, request, session
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 
+from cache import LRUCache
 from config import AUTH_COOKIE
-from odie import ClientError
-from db.fsmi import Cookie
+from odie import app, ClientError
+from db.fsmi import Cookie, refresh_session
 
 
 def unauthorized():
     raise ClientError("unauthorized", status=401)
 
 
-def get_user():
-    # kiosk Mode is *never* logged in.
-    if is_kiosk():
+def route_name():
+    rule = request.url_rule.rule if request.url_rule else request.path
+    return '{} {}'.format(request.method, rule)
+
+
+class SessionUser(object):
+    """Detached snapshot of a db.fsmi.User, as handed out by get_user()
+
+    Has everything the rest of odie needs to know about a user, so answering
+    has_permission() doesn't require the database.
+    """
+    __slots__ = ('id', 'username', 'first_name', 'last_name', 'permission_mask')
+
+    def __init__(self, id, username, first_name, last_name, permission_mask):
+        self.id = id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.permission_mask = permission_mask
+
+    @staticmethod
+    def from_user(user):
+        return SessionUser(user.id, user.username, user.first_name, user.last_name, user.permission_mask)
+
+    @property
+    def full_name(self):
+        return self.first_name + ' ' + self.last_name
+
+    def has_permission(self, *perm_names):
+        return bool(self.permission_mask & acl.permission_mask(*perm_names))
+
+
+class _CachedSession(object):
+    __slots__ = ('user', 'last_action', 'lifetime')
+
+    def __init__(self, user, last_action, lifetime):
+        self.user = user
+        self.last_action = last_action
+        self.lifetime = lifetime
+
+    @property
+    def expired(self):
+        return self.last_action + datetime.timedelta(seconds=self.lifetime) < datetime.datetime.now()
+
+
+# FSMISESSID -> _CachedSession. Each worker process has its own cache, so sessions deleted from the fsmi
+# database by anyone but this process (e.g. by the fsmi logout page) stay valid for up to SESSION_CACHE_TTL.
+_session_cache = LRUCache('session_cache', config.SESSION_CACHE_SIZE, ttl=config.SESSION_CACHE_TTL)
+
+
+def evict_sessions(user_id):
+    _session_cache.evict_where(lambda cached: cached.user.id == user_id)
+
+
+# Non-browser API clients (counter terminals, kiosks...) may authenticate with a short-lived signed token instead
+# of the session cookie, which spares the fsmi database entirely. Tokens can't be revoked individually;
+# bumping API_TOKEN_EPOCH invalidates all of them.
+_token_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='odie-api-token',
+                                           signer_kwargs={'digest_method': hashlib.sha256})
+
+
+def issue_api_token(user):
+    return _token_serializer.dumps({
+        'id': user.id,
+        'username': user.username,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'permissions': user.permission_mask,
+        'epoch': config.API_TOKEN_EPOCH,
+    })
+
+
+def _verify_api_token(token):
+    try:
+        data = _token_serializer.loads(token, max_age=config.API_TOKEN_LIFETIME)
+    except BadSignature:  # includes expired tokens
+        return None
+    if data.get('epoch') != config.API_TOKEN_EPOCH:
         return None
+    return SessionUser(data['id'], data['username'], data['first_name'], data['last_name'], data['permissions'])
+
+
+def _api_token():
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        return auth[len('Bearer '):]
+    return None
+
+
+def authenticated_by_token():
+    return _api_token() is not None and get_user() is not None
+
+
+def _lookup_user():
+    token = _api_token()
+    if token is not None:
+        return _verify_api_token(token)
     cookie = request.cookies.get(AUTH_COOKIE)
     if not cookie:
         return None
-    active_session = Cookie.query.filter_by(sid=cookie).first()
-    if active_session:
-        active_session.refresh()
-        return active_session.user
+    cached = _session_cache.get(cookie)
+    if cached is None or cached.expired:
+        # a session has a row per refresh, the newest one counts
+        active_session = Cookie.query.filter_by(sid=cookie).order_by(Cookie.last_action.desc()).first()
+        if not active_session:
+            _session_cache.evict(cookie)
+            return None
+        cached = _CachedSession(SessionUser.from_user(active_session.user), active_session.last_action, active_session.lifetime)
+        _session_cache.put(cookie, cached)
+    cached.last_action = refresh_session(cookie, cached.user.id, cached.last_action, cached.lifetime)
+    return cached.user
+
+
+def get_user():
+    # kiosk Mode is *never* logged in.
+    if is_kiosk():
+        return None
+    # A single request asks for its user from lots of places (login_required, jsonify, schemas...),
+    # so the session is only looked up (and refreshed) once. g lives exactly as long as the request.
+    if '_user' in g:
+        metrics.incr('get_user_memoized', route_name())
+        return g._user
+    with timing.phase('auth'):
+        g._user = _lookup_user()
+    return g._user
 
 def is_kiosk():
     return session.get('is_kiosk', False)
@@ -0,0 +1,25 @@
+#! /usr/bin/env python3
+
+# Process-local counters for the shortcuts odie takes (memoized lookups, skipped writes, cache hits...).
+# Every worker process keeps its own numbers, so they only ever describe the process that reports them.
+
+import collections
+import threading
+
+_lock = threading.Lock()
+_counters = collections.defaultdict(collections.Counter)
+
+
+def incr(group, key, amount=1):
+    with _lock:
+        _counters[group][key] += amount
+
+
+def snapshot():
+    with _lock:
+        result = {group: dict(counter) for group, counter in _counters.items()}
+    for counter in result.values():
+        if 'hits' in counter or 'misses' in counter:
+            lookups = counter.get('hits', 0) + counter.get('misses', 0)
+            counter['hit_rate'] = counter.get('hits', 0) / lookups
+    return result
@@ -3,6 +3,7 @@
 import config
 
 from login import get_user
+from api_utils import precompiled
 
 from functools import partial
 from marshmallow import fields, Schema
@@ -10,10 +11,12 @@ from marshmallow.utils import missing
 from marshmallow.validate import OneOf
 
 
+@precompiled
 class IdSchema(Schema):
     id = fields.Int(required=True)
 
 
+@precompiled
 class DocumentDumpSchema(IdSchema):
     department = fields.Str()
     lectures = fields.List(fields.Nested(IdSchema))
@@ -7,18 +7,22 @@ import json
 import os
 import marshmallow
 
+from functools import partial
 from flask import request, send_file
 from marshmallow import Schema, fields
 from marshmallow.validate import OneOf
-from sqlalchemy import asc, desc
+from sqlalchemy import asc, desc, extract, func, or_, tuple_
 from sqlalchemy.orm import subqueryload, undefer
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql import select
 from pytz import reference
 
 from .common import IdSchema, DocumentDumpSchema
 from odie import app, sqla, csrf, ClientError
 from login import login_required, get_user, is_kiosk, unauthorized
-from api_utils import endpoint, api_route, handle_client_errors, document_path, number_of_pages, save_file, serialize, event_stream
+from api_utils import endpoint, api_route, handle_client_errors, document_path, number_of_pages, save_file, serialize, event_stream, \
+    precompiled, table_versions, PaginatedResultSchema, EncodedJSON
+from cache import LRUCache
 from db.documents import Lecture, Document, Examinant
 
 
@@ -41,6 +45,7 @@ def scanner(location, id):
             yield (None, serialize(doc, lambda: schema))
 
 
+@precompiled
 class LectureDumpSchema(IdSchema):
     name = fields.Str()
     aliases = fields.List(fields.Str())
@@ -48,28 +53,115 @@ class LectureDumpSchema(IdSchema):
     validated = fields.Boolean()
     early_document_until = fields.AwareDateTime(default_timezone=reference.LocalTimezone())
     early_document_eligible = fields.Boolean()
+    facets = fields.Raw()
 
-api_route('/api/lectures')(
+api_route('/api/lectures',
+          versioned_by=('documents.lectures', 'documents.documents', 'documents.lecture_docs'),
+          version_interval=config.TIME_DEPENDENT_ETAG_INTERVAL)(
 endpoint(
         schemas={'GET': LectureDumpSchema},
-        query_fn=lambda: Lecture.query.options(undefer('early_document_until')),
-        paginate_many=False)
+        query_fn=lambda: Lecture.query.options(undefer('early_document_until'), undefer('facets')),
+        paginate_many=False,
+        stream_many=True)
 )
 
 
+@precompiled
 class ExaminantSchema(IdSchema):
     name = fields.Str()
     validated = fields.Boolean()
+    facets = fields.Raw()
 
 
-api_route('/api/examinants')(
+api_route('/api/examinants',
+          versioned_by=('documents.examinants', 'documents.documents', 'documents.document_examinants'))(
 endpoint(
         schemas={'GET': ExaminantSchema},
-        query_fn=lambda: Examinant.query,
-        paginate_many=False)
+        query_fn=lambda: Examinant.query.options(undefer('facets')),
+        paginate_many=False,
+        stream_many=True)
 )
 
 
+def _search_params():
+    """Returns the (term, limit) of a search request"""
+    term = request.args.get('q', '').strip()
+    if not term:
+        raise ClientError('missing search term', status=400)
+    try:
+        limit = int(request.args.get('limit', config.SEARCH_RESULTS))
+    except ValueError:
+        raise ClientError('invalid limit', status=400)
+    return (term, max(1, min(limit, config.SEARCH_MAX_RESULTS)))
+
+
+def _search(query, columns, order_by):
+    """Returns the best matches among the rows of `query` having all words of the search term in one of `columns`
+
+    The ILIKEs are answered by the trigram indexes (see db.documents.SEARCH_INDEX_CALLS), the matches are ranked by
+    how similar the best matching column is to the term.
+    """
+    (term, limit) = _search_params()
+    for word in term.split():
+        pattern = '%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        query = query.filter(or_(*(column.ilike(pattern) for column in columns)))
+    rank = func.greatest(*(func.word_similarity(term, column) for column in columns))
+    return query.order_by(rank.desc(), order_by).limit(limit)
+
+
+# without the facets and early document rewards, which would need further queries
+_LectureSearchSchema = partial(LectureDumpSchema, only=('id', 'name', 'aliases', 'comment', 'validated'))
+_ExaminantSearchSchema = partial(ExaminantSchema, only=('id', 'name', 'validated'))
+
+
+@api_route('/api/search/lectures', versioned_by=('documents.lectures',))
+def search_lectures():
+    return serialize(_search(Lecture.query, (Lecture.name, Lecture.aliases_text), Lecture.name).all(),
+                     _LectureSearchSchema, many=True)
+
+
+@api_route('/api/search/examinants', versioned_by=('documents.examinants',))
+def search_examinants():
+    return serialize(_search(Examinant.query, (Examinant.name,), Examinant.name).all(), _ExaminantSearchSchema,
+                     many=True)
+
+
+# tables /api/documents responses depend on
+DOCUMENT_TABLES = ('documents.documents', 'documents.lectures', 'documents.examinants', 'documents.lecture_docs',
+                   'documents.document_examinants')
+
+# columns anonymous users may sort documents by
+DOCUMENT_SORT_COLUMNS = ('date', 'number_of_pages', 'validation_time')
+
+DOCUMENT_TYPES = ('written', 'oral', 'oral reexam', 'mock exam')
+
+
+def _anonymous_q(param_q):
+    """Parses the 'q' parameter of anonymous requests into (sort, document_types)
+
+    sort is None or ('order_by_asc'/'order_by_desc', column), document_types None or a sorted tuple.
+    Everything not matching the whitelisted shape is ignored.
+    """
+    sort = None
+    document_types = None
+    # While it looks ugly, we validate all parameters to ensure that the JSON structure is as expected and that only
+    # whitelisted values work.
+    if param_q.get('operator') in ('order_by_desc', 'order_by_asc') and \
+            param_q.get('column') in DOCUMENT_SORT_COLUMNS:
+        sort = (param_q['operator'], param_q['column'])
+
+    if isinstance(param_q.get('value'), dict) and \
+            param_q['value'].get('operator') == 'and' and \
+            isinstance(param_q['value'].get('value'), list) and \
+            len(param_q['value']['value']) == 1 and \
+            param_q['value']['value'][0].get('column') == 'document_type' and \
+            param_q['value']['value'][0].get('operator') == 'in_' and \
+            isinstance(param_q['value']['value'][0].get('value'), list) and \
+            all(value in DOCUMENT_TYPES for value in param_q['value']['value'][0]['value']):
+        document_types = tuple(sorted(set(param_q['value']['value'][0]['value'])))
+    return sort, document_types
+
+
 def documents_query():
     query = Document.query.options(subqueryload('lectures'), subqueryload('examinants'))
     param_filters = json.loads(request.args.get('filters', '{}'))
@@ -88,47 +180,124 @@ def documents_query():
     # the `submitted_by` filter in the depositreturn view; logged in users have access to all the data anyway.
     # Note that the `page` parameter is taken into account by endpoint()/filtered_results() in either case.
     if not get_user():
-        param_q = json.loads(request.args.get('q', '{}'))
-        # While it looks ugly, we validate all parameters to ensure that the JSON structure is as expected and that only
-        # whitelisted values work.
-        if param_q.get('operator') in ('order_by_desc', 'order_by_asc') and \
-                param_q.get('column') in ('date', 'number_of_pages', 'validation_time'):
-            sort_fn = asc if param_q.get('operator') == 'order_by_asc' else desc
-            query = query.order_by(sort_fn(param_q['column']))
-
-        if isinstance(param_q.get('value'), dict) and \
-                param_q['value'].get('operator') == 'and' and \
-                isinstance(param_q['value'].get('value'), list) and \
-                len(param_q['value']['value']) == 1 and \
-                param_q['value']['value'][0].get('column') == 'document_type' and \
-                param_q['value']['value'][0].get('operator') == 'in_' and \
-                isinstance(param_q['value']['value'][0].get('value'), list) and \
-                all(value in ('written', 'oral', 'oral reexam', 'mock exam') for value in param_q['value']['value'][0]['value']):
-            query = query.filter(Document.document_type.in_(param_q['value']['value'][0]['value']))
+        (sort, document_types) = _anonymous_q(json.loads(request.args.get('q', '{}')))
+        if sort is not None:
+            (operator, column) = sort
+            sort_fn = asc if operator == 'order_by_asc' else desc
+            query = query.order_by(sort_fn(column))
+        if document_types is not None:
+            query = query.filter(Document.document_type.in_(document_types))
 
     return query
 
-api_route('/api/documents')(
-endpoint(
+
+_documents_endpoint = endpoint(
         schemas={'GET': DocumentDumpSchema},
         query_fn=documents_query,
+        sort_columns=DOCUMENT_SORT_COLUMNS,
+        count='estimated',
         # Allow insecure JSON queries for logged in users so that the `submitted_by` filter in the depositreturn.html
         # view works.
         allow_insecure_authenticated=True)
-)
 
-# aggregate values of unpaginated source data
-@api_route('/api/documents/meta')
-def documents_metadata():
-    q = documents_query()
+
+# Anonymous requests can only ask for the few things _anonymous_q() and the filters allow, so their responses are
+# cached as serialized JSON. Entries are keyed by the versions of DOCUMENT_TABLES, too, and dropped as soon as one
+# of them changes.
+_response_cache = LRUCache('documents_response_cache', config.DOCUMENTS_CACHE_SIZE,
+                           max_bytes=config.DOCUMENTS_CACHE_BYTES)
+_response_cache_versions = None
+
+
+def _sorted_ids(values):
+    if not isinstance(values, list) or not all(type(value) is int for value in values):
+        return None
+    return tuple(sorted(set(values)))
+
+
+def _anonymous_cache_key():
+    """Returns the normalized parameters of an anonymous /api/documents request, or None if it's not cacheable"""
+    if get_user():
+        return None
+    param_filters = json.loads(request.args.get('filters', '{}'))
+    param_q = json.loads(request.args.get('q', '{}'))
+    if not isinstance(param_filters, dict) or not isinstance(param_q, dict) or 'cursor' in param_q:
+        return None
+    lectures = _sorted_ids(param_filters.get('includes_lectures', []))
+    examinants = _sorted_ids(param_filters.get('includes_examinants', []))
+    page = param_q.get('page', 1)
+    if lectures is None or examinants is None or type(page) is not int:
+        return None
+    return (lectures, examinants, _anonymous_q(param_q), page, request.args.get('count'), request.args.get('fields'))
+
+
+@api_route('/api/documents', versioned_by=DOCUMENT_TABLES, statement_timeout=config.JSONQUERY_STATEMENT_TIMEOUT)
+def get_documents():
+    global _response_cache_versions
+    key = _anonymous_cache_key()
+    if key is None:
+        return _documents_endpoint()
+    versions = table_versions()
+    versions = tuple(versions.get(table) for table in DOCUMENT_TABLES)
+    if versions != _response_cache_versions:
+        _response_cache.clear()
+        _response_cache_versions = versions
+    cached = _response_cache.get((key, versions))
+    if cached is None:
+        cached = EncodedJSON(serialize(_documents_endpoint(), PaginatedResultSchema))
+        _response_cache.put((key, versions), cached, size=cached.size)
+    return cached
+
+# Totals only depend on the filters (and, for anonymous users, the document types in 'q'), so they're cached
+# per normalized filter. The key includes the versions of DOCUMENT_TABLES, so changes make old entries unreachable.
+_meta_cache = LRUCache('documents_meta_cache', config.DOCUMENTS_META_CACHE_SIZE)
+
+# bits of GROUPING(document_type, department, year) for the rows of each grouping set
+_META_GROUPS = {0b011: 'document_type', 0b101: 'department', 0b110: 'year'}
+
+
+def _documents_metadata():
+    docs = documents_query().order_by(None).subquery()
+    year = extract('year', docs.c.date)
+    columns = (docs.c.document_type, docs.c.department, year)
+    stmt = select([func.grouping(*columns), *columns, func.count()]) \
+        .group_by(func.grouping_sets(*(tuple_(column) for column in columns)))
+    totals = {'document_type': {}, 'department': {}, 'year': {}}
+    for (grouping, document_type, department, row_year, count) in sqla.session.execute(stmt, mapper=Document):
+        group = _META_GROUPS[grouping]
+        value = {'document_type': document_type, 'department': department, 'year': row_year}[group]
+        if value is not None:
+            totals[group][int(value) if group == 'year' else value] = count
     return {
-        'total_written': q.filter_by(document_type='written').count(),
-        'total_oral': q.filter_by(document_type='oral').count(),
-        'total_oral_reexam': q.filter_by(document_type='oral reexam').count(),
-        'total_mock_exam': q.filter_by(document_type='mock exam').count(),
+        'total_written': totals['document_type'].get('written', 0),
+        'total_oral': totals['document_type'].get('oral', 0),
+        'total_oral_reexam': totals['document_type'].get('oral reexam', 0),
+        'total_mock_exam': totals['document_type'].get('mock exam', 0),
+        'by_department': totals['department'],
+        'by_year': totals['year'],
     }
 
 
+# aggregate values of unpaginated source data, counted in a single pass
+@api_route('/api/documents/meta', versioned_by=DOCUMENT_TABLES)
+def documents_metadata():
+    param_filters = json.loads(request.args.get('filters', '{}'))
+    if not isinstance(param_filters, dict):
+        return _documents_metadata()
+    lectures = _sorted_ids(param_filters.get('includes_lectures', []))
+    examinants = _sorted_ids(param_filters.get('includes_examinants', []))
+    if lectures is None or examinants is None:
+        return _documents_metadata()
+    document_types = None if get_user() else _anonymous_q(json.loads(request.args.get('q', '{}')))[1]
+    versions = table_versions()
+    key = (lectures, examinants, document_types, tuple(versions.get(table) for table in DOCUMENT_TABLES))
+    result = _meta_cache.get(key)
+    if result is None:
+        result = _documents_metadata()
+        _meta_cache.put(key, result)
+    return result
+
+
 class DocumentLoadSchema(Schema):  # used by document submission
     department = fields.Str(required=True, validate=OneOf(['computer science', 'mathematics', 'other']))
     lectures = fields.List(fields.Str(), required=True)
@@ -1,27 +1,39 @@
 #! /usr/bin/env python3
 
 import config
+import json
+import metrics
+import urllib.parse
 
-from flask import session, make_response
+from flask import request, session, make_response
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
 from marshmallow import fields, post_load, Schema
 from marshmallow.validate import Length
 from sqlalchemy.orm import subqueryload
 
 from .common import IdSchema, DocumentDumpSchema
-from odie import app, csrf
-from login import get_user, is_kiosk, login_required
-from api_utils import endpoint, api_route, handle_client_errors, serialize
+from odie import app, csrf, sqla, ClientError
+from login import get_user, is_kiosk, login_required, unauthorized, issue_api_token, authenticated_by_token
+from api_utils import endpoint, api_route, handle_client_errors, serialize, precompiled
 from db.documents import Deposit
 from db.odie import Order
 
 ## Routes may either return something which can be turned into json using
-## flask.jsonify or a api_utils.PaginatedResult. The actual response is assembled
-## in api_utils.api_route.
+## flask.jsonify or a api_utils.PaginatedResult/StreamedResult/EncodedJSON. The actual
+## response is assembled in api_utils.api_route.
 
-@api_route('/api/config')
+@api_route('/api/config', versioned_by=())
 def get_config():
     return dict(config.FS_CONFIG, IS_KIOSK=is_kiosk())
 
+@api_route('/api/metrics')
+@login_required
+def get_metrics():
+    if not get_user().has_permission(*config.ADMIN_PANEL_ALLOWED_GROUPS):
+        return unauthorized()
+    return metrics.snapshot()
+
 @app.route('/kiosk')
 @handle_client_errors
 @login_required
@@ -43,6 +55,7 @@ class UserDumpSchema(Schema):
 class LoginDumpSchema(Schema):
     user = fields.Nested(UserDumpSchema)
     token = fields.Str()
+    api_token = fields.Str()
 
 # exempting this from CSRF is okay since the dangers of CSRF only apply to endpoints that do something
 # whereas this simply returns some data. As long as CORS is set up correctly, we're fine
@@ -52,9 +65,15 @@ class LoginDumpSchema(Schema):
 @login_required
 def user_info():
     # Explicitly pass the csrf token cookie value for cross-origin clients.
-    return serialize({'user': get_user(), 'token': csrf._get_token()}, LoginDumpSchema)
+    info = {'user': get_user(), 'token': csrf._get_token()}
+    # Non-browser clients can opt into a signed API token. It can't be renewed with itself,
+    # otherwise tokens wouldn't be short-lived at all.
+    if request.args.get('api_token') and not authenticated_by_token():
+        info['api_token'] = issue_api_token(get_user())
+    return serialize(info, LoginDumpSchema)
 
 
+@precompiled
 class OrderDumpSchema(IdSchema):
     name = fields.Str()
     documents = fields.List(fields.Nested(DocumentDumpSchema))
@@ -68,7 +87,8 @@ login_required(
             'GET': OrderDumpSchema,
         },
         query_fn=lambda: Order.query.options(subqueryload('items.document.lectures'), subqueryload('items.document.examinants')),
-        allow_insecure_authenticated=True
+        allow_insecure_authenticated=True,
+        statement_timeout=config.JSONQUERY_STATEMENT_TIMEOUT
     )
 ))
 
@@ -104,6 +124,7 @@ endpoint(
 ))
 
 
+@precompiled
 class DepositDumpSchema(IdSchema):
     price = fields.Int()
     name = fields.Str()
@@ -116,6 +137,87 @@ login_required(
     endpoint(
         schemas={'GET': DepositDumpSchema},
         query_fn=lambda: Deposit.query.options(subqueryload('lectures')),
-        allow_insecure_authenticated=True
+        allow_insecure_authenticated=True,
+        statement_timeout=config.JSONQUERY_STATEMENT_TIMEOUT
     ),
 ))
+
+
+# request headers not passed on to the requests of a batch: batched responses are always plain JSON, and
+# conditional requests only make sense for the batch as a whole
+_UNBATCHED_HEADERS = {'host', 'content-length', 'content-type', 'accept', 'accept-encoding', 'if-none-match',
+                      'if-modified-since'}
+
+
+# The only routes a batch may contain: api_route GETs answering with a bounded JSON body and without side effects.
+# Event streams (/api/print, /api/scanner/...), files (/api/view/...) and everything else are refused.
+BATCHABLE_ROUTES = frozenset([
+    '/api/config',
+    '/api/user_info',
+    '/api/metrics',
+    '/api/lectures',
+    '/api/examinants',
+    '/api/documents',
+    '/api/documents/meta',
+    '/api/orders',
+    '/api/deposits',
+    '/api/search/lectures',
+    '/api/search/examinants',
+])
+
+
+def _check_batchable(url):
+    (scheme, netloc, path, _, _) = urllib.parse.urlsplit(url)
+    if scheme or netloc:
+        raise ClientError('invalid batched URL: ' + url)
+    try:
+        (rule, _) = app.create_url_adapter(request).match(path, method='GET', return_rule=True)
+    except HTTPException:  # includes redirects
+        raise ClientError('invalid batched URL: ' + url)
+    if rule.rule not in BATCHABLE_ROUTES:
+        raise ClientError('invalid batched URL: ' + url)
+
+
+def _batched_get(url):
+    headers = [(key, value) for (key, value) in request.headers if key.lower() not in _UNBATCHED_HEADERS]
+    headers.append(('Accept', 'application/json'))
+    builder = EnvironBuilder(path=url, base_url=request.host_url, method='GET', headers=headers)
+    # The application context, and with it g and the memoized user, is shared with the batch request, but every
+    # batched request gets a transaction of its own, so its route's statement_timeout applies (see api_route) and a
+    # timeout doesn't abort the rest of the batch.
+    sqla.session.commit()
+    with app.request_context(builder.get_environ()):
+        try:
+            response = app.full_dispatch_request()
+            if response.mimetype != 'application/json':
+                # never read anything but JSON, it might be an endless stream
+                response.close()
+                return {'status': 400, 'body': None}
+            body = response.get_data()  # streamed responses need the request context
+            response.close()
+        except Exception:  # pylint: disable=broad-except
+            app.logger.exception('batched request to %s failed', url)
+            sqla.session.rollback()
+            return {'status': 500, 'body': None}
+    try:
+        return {'status': response.status_code, 'body': json.loads(body.decode('utf-8')) if body else None}
+    except ValueError:
+        return {'status': response.status_code, 'body': None}
+
+
+# Runs several GET requests at once, e.g. everything the client needs on start-up:
+# /api/batch?requests=["/api/config","/api/user_info","/api/lectures"]
+# Returns {"data": {<url>: {"status": <status code>, "body": <response>}}}.
+@api_route('/api/batch')
+def batch():
+    try:
+        urls = json.loads(request.args.get('requests', '[]'))
+    except ValueError:
+        raise ClientError('requests must be a JSON list of URLs')
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        raise ClientError('requests must be a JSON list of URLs')
+    if len(urls) > config.BATCH_MAX_REQUESTS:
+        raise ClientError('at most {} requests per batch'.format(config.BATCH_MAX_REQUESTS))
+    for url in urls:
+        _check_batchable(url)
+    return {url: _batched_get(url) for url in urls}
@@ -61,8 +61,9 @@ def print_documents():
     try:
         if documents:
             db.accounting.log_exam_sale(num_pages, print_price, user, data['cash_box'])
-        for _ in range(data['deposit_count']):
+        if data['deposit_count']:
             lectures = Lecture.query.filter(Lecture.documents.any(Document.id.in_(document_ids))).all()
+        for _ in range(data['deposit_count']):
             dep = Deposit(
                     price=config.FS_CONFIG['DEPOSIT_PRICE'],
                     name=data['cover_text'],
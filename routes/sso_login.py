@@ -13,7 +13,7 @@ from flask import request, redirect
 from api_utils import handle_client_errors
 from config import AUTH_COOKIE
 from odie import app, csrf, sqla
-from login import get_user, login_required
+from login import get_user, login_required, evict_sessions
 from db.fsmi import User, Cookie
 
 login_page_text = """<html>
@@ -30,6 +30,7 @@ login_page_text = """<html>
 
 @app.route('/login', methods=['GET', 'POST'])
 @csrf.exempt
+@handle_client_errors
 def login_page():
     if request.method == 'GET':
         # NB: Due to severe PHP, you'll need to also provide a (potentially empty)
@@ -38,7 +39,7 @@ def login_page():
         return login_page_text % urllib.parse.quote_plus(request.args.get('target_path'))
     user = User.authenticate(request.form['username'], request.form['password'])
     if user:
-        # see comment in fsmi.Cookie.refresh as to why we need this in python
+        # see comment in fsmi.flush_refreshes as to why we need this in python
         now = datetime.datetime.now()
         cookie = str(uuid.uuid4())
         sqla.session.add(Cookie(sid=cookie, user_id=user.id, last_action=now, lifetime=172800))
@@ -56,6 +57,7 @@ def login_page():
 def logout():
     Cookie.query.filter_by(user_id=get_user().id).delete()
     sqla.session.commit()
+    evict_sessions(get_user().id)
     response = app.make_response(redirect(request.args.get('target_path')))
     response.set_cookie(AUTH_COOKIE, value='', expires=0)
     return response
@@ -28,7 +28,8 @@ import db.odie  # pylint: disable=unused-import
 
 from sqlalchemy.schema import CreateSchema
 from odie import sqla, app
-from db.documents import Lecture
+from db.documents import Lecture, FACET_STORED_PROCEDURE_CALLS, SEARCH_INDEX_CALLS
+from db.odie import TableVersion
 
 def createSchema(name, bind=None):
     try:
@@ -54,3 +55,26 @@ try:
 except sqlalchemy.exc.ProgrammingError as e:
         print("Error creating stored procedure, ignoring: {}".format(e))
 
+# create triggers maintaining odie.table_versions
+try:
+    engine = sqla.get_engine(app,None)
+    for call in TableVersion.stored_procedure_calls:
+        engine.execute(call)
+except sqlalchemy.exc.ProgrammingError as e:
+        print("Error creating table version triggers, ignoring: {}".format(e))
+
+# create trigram search indexes
+try:
+    engine = sqla.get_engine(app,None)
+    for call in SEARCH_INDEX_CALLS:
+        engine.execute(call)
+except sqlalchemy.exc.ProgrammingError as e:
+        print("Error creating search indexes, ignoring: {}".format(e))
+
+# create triggers maintaining the lecture and examinant facets
+try:
+    engine = sqla.get_engine(app,None)
+    for call in FACET_STORED_PROCEDURE_CALLS:
+        engine.execute(call)
+except sqlalchemy.exc.ProgrammingError as e:
+        print("Error creating facet triggers, ignoring: {}".format(e))
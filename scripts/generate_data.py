@@ -0,0 +1,250 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""Fills the local database with a large, randomly generated data set
+
+Unlike fill_data.py, which adds a handful of hand-written objects through the ORM, this streams rows straight
+into Postgres with COPY, so that production-sized fixtures (a million documents and their lecture and examinant
+links) take minutes instead of hours. The same arguments and --seed always produce the same data.
+
+All tables filled by this script are truncated first. Users, permissions and sessions are left alone, so run
+fill_data.py first if you need to log in.
+"""
+
+try:
+    import hack
+except:
+    from scripts import hack
+
+import argparse
+import config
+import datetime
+import io
+import os
+import random
+import time
+
+import db.documents  # pylint: disable=unused-import
+import db.garfield  # pylint: disable=unused-import
+import db.odie  # pylint: disable=unused-import
+
+from odie import app, sqla
+from db.documents import FACET_BACKFILL
+from api_utils import document_path
+
+PLACEHOLDER_PDF = os.path.join(os.path.dirname(__file__), os.pardir, 'test', 'upload.pdf')
+
+# in the order they're filled. Truncated with CASCADE, so the link and facet tables don't need to be listed.
+TABLES = [
+    'garfield.locations',
+    'documents.lectures',
+    'documents.examinants',
+    'documents.documents',
+    'documents.folders',
+    'documents.deposits',
+    'odie.orders',
+]
+# tables whose 'facets' trigger maintains documents.lecture_facets and documents.examinant_facets
+FACET_TABLES = ['documents.lecture_docs', 'documents.document_examinants']
+
+SUBJECTS = ['Analysis', 'Lineare Algebra', 'Algorithmen', 'Rechnerstrukturen', 'Betriebssysteme', 'Compilerbau',
+            'Kryptographie', 'Datenbanksysteme', 'Numerik', 'Stochastik', 'Robotik', 'Softwaretechnik',
+            'Topologie', 'Funktionentheorie', 'Maschinelles Lernen', 'Rechnernetze', 'Telematik', 'Logik']
+PREFIXES = ['', 'Einführung in die ', 'Grundlagen der ', 'Fortgeschrittene ', 'Praxis der ', 'Theorie der ']
+FIRST_NAMES = ['Anna', 'Bernd', 'Clara', 'Dieter', 'Eva', 'Frank', 'Greta', 'Hans', 'Ines', 'Jürgen', 'Katrin',
+               'Lars', 'Maria', 'Niklas', 'Olga', 'Peter', 'Renate', 'Stefan', 'Tanja', 'Uwe']
+LAST_NAMES = ['Müller', 'Schmidt', 'Schneider', 'Fischer', 'Weber', 'Meyer', 'Wagner', 'Becker', 'Schulz',
+              'Hoffmann', 'Koch', 'Richter', 'Klein', 'Wolf', 'Schröder', 'Neumann', 'Schwarz', 'Zimmermann']
+DOCUMENT_TYPES = ['oral'] * 6 + ['written'] * 3 + ['oral reexam', 'mock exam']
+DEPARTMENTS = ['computer science'] * 5 + ['mathematics'] * 4 + ['other']
+
+
+def _copy_value(value):
+    """Formats a value for COPY's text format"""
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        return 't' if value else 'f'
+    if isinstance(value, (list, tuple)):
+        # only used for arrays of generated names, which contain neither quotes nor backslashes
+        value = '{' + ','.join('"{}"'.format(item) for item in value) + '}'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+class _RowStream(io.RawIOBase):
+    """File-like object serving rows to cursor.copy_expert() without building the whole table in memory"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = b''
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.count += 1
+            self.buffer += ('\t'.join(_copy_value(value) for value in row) + '\n').encode('utf-8')
+        if size < 0:
+            size = len(self.buffer)
+        (chunk, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return chunk
+
+
+def copy(cursor, table, columns, rows):
+    start = time.perf_counter()
+    stream = _RowStream(iter(rows))
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), stream, size=1 << 16)
+    print('{}: {} rows in {:.1f} s'.format(table, stream.count, time.perf_counter() - start))
+
+
+def random_date(rng, start, end):
+    return start + datetime.timedelta(days=rng.randrange((end - start).days))
+
+
+def generate(cursor, args):
+    rng = random.Random(args.seed)
+    today = datetime.date(2026, 1, 1)  # fixed, so the data doesn't depend on the day it's generated
+
+    copy(cursor, 'garfield.locations', ['location_id', 'location_name', 'location_description'],
+         [(1, 'FSI', 'Info-Raum'), (2, 'FSM', 'Mathe-Raum')])
+
+    copy(cursor, 'documents.lectures', ['id', 'name', 'aliases', 'comment', 'validated'], (
+        (id, '{}{} {}'.format(rng.choice(PREFIXES), rng.choice(SUBJECTS), id),
+         ['L{}'.format(id)] if id % 4 == 0 else [], '', rng.random() < 0.95)
+        for id in range(1, args.lectures + 1)))
+
+    copy(cursor, 'documents.examinants', ['id', 'name', 'validated'], (
+        (id, '{} {} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), id), rng.random() < 0.95)
+        for id in range(1, args.examinants + 1)))
+
+    def documents():
+        for id in range(1, args.documents + 1):
+            document_type = rng.choice(DOCUMENT_TYPES)
+            date = random_date(rng, datetime.date(2000, 1, 1), today)
+            validated = rng.random() < 0.9
+            submitted_by = None if validated and rng.random() < 0.8 else 'Student {}'.format(rng.randrange(10000))
+            yield (id, rng.choice(DEPARTMENTS), date, rng.randint(1, 12),
+                   rng.choice(['official', 'inofficial', 'none']) if document_type == 'written' else None,
+                   '', document_type, rng.random() < args.file_ratio,
+                   datetime.datetime.combine(date + datetime.timedelta(days=rng.randrange(30)), datetime.time(12))
+                   if validated else None,
+                   submitted_by, submitted_by is not None and rng.random() < 0.3,
+                   submitted_by is not None and rng.random() < 0.3, rng.random() < 0.2)
+    copy(cursor, 'documents.documents', ['id', 'department', 'date', 'number_of_pages', 'solution', 'comment',
+                                         'document_type', 'has_file', 'validation_time', 'submitted_by',
+                                         'early_document_eligible', 'deposit_return_eligible', 'publicly_available'],
+         documents())
+
+    def links(count, per_document):
+        # popular lectures and examinants get most documents, like in real life
+        for document_id in range(1, args.documents + 1):
+            k = min(count, max(1, round(rng.gauss(per_document, per_document / 2))))
+            targets = set()
+            while len(targets) < k:
+                # log-uniform ids: half of the links go to the first sqrt(count) ones
+                targets.add(min(count, int((count + 1) ** rng.random())))
+            for target in targets:
+                yield (target, document_id)
+    copy(cursor, 'documents.lecture_docs', ['lecture_id', 'document_id'],
+         links(args.lectures, args.lectures_per_document))
+    copy(cursor, 'documents.document_examinants', ['examinant_id', 'document_id'],
+         links(args.examinants, args.examinants_per_document))
+
+    copy(cursor, 'documents.folders', ['id', 'name', 'location_id', 'document_type'], (
+        (id, 'Ordner {}'.format(id), 1 + id % 2, rng.choice(DOCUMENT_TYPES)) for id in range(1, args.folders + 1)))
+    copy(cursor, 'documents.folder_lectures', ['folder_id', 'lecture_id'], (
+        (folder_id, lecture_id) for folder_id in range(1, args.folders + 1)
+        for lecture_id in rng.sample(range(1, args.lectures + 1), min(args.lectures, 3))))
+    copy(cursor, 'documents.folder_examinants', ['folder_id', 'examinant_id'], (
+        (folder_id, examinant_id) for folder_id in range(1, args.folders + 1)
+        for examinant_id in rng.sample(range(1, args.examinants + 1), min(args.examinants, 2))))
+
+    deposit_price = config.FS_CONFIG['DEPOSIT_PRICE']
+    copy(cursor, 'documents.deposits', ['id', 'price', 'name', 'by_user', 'date'], (
+        (id, deposit_price, 'Student {}'.format(rng.randrange(10000)), 'guybrush',
+         datetime.datetime.combine(random_date(rng, datetime.date(2015, 1, 1), today), datetime.time(12)))
+        for id in range(1, args.deposits + 1)))
+    copy(cursor, 'documents.deposit_lectures', ['deposit_id', 'lecture_id'], (
+        (deposit_id, lecture_id) for deposit_id in range(1, args.deposits + 1)
+        for lecture_id in rng.sample(range(1, args.lectures + 1), min(args.lectures, rng.randint(1, 3)))))
+
+    copy(cursor, 'odie.orders', ['id', 'name', 'creation_time'], (
+        (id, 'Order {}'.format(id),
+         datetime.datetime.combine(random_date(rng, datetime.date(2015, 1, 1), today), datetime.time(12)))
+        for id in range(1, args.orders + 1)))
+    copy(cursor, 'odie.order_documents', ['index', 'order_id', 'document_id'], (
+        (index, order_id, document_id) for order_id in range(1, args.orders + 1)
+        for (index, document_id) in enumerate(rng.sample(range(1, args.documents + 1),
+                                                         min(args.documents, args.documents_per_order)))))
+
+
+def reset_sequences(cursor):
+    for (table, column) in [('garfield.locations', 'location_id')] + [(table, 'id') for table in TABLES[1:]]:
+        cursor.execute("SELECT setval(pg_get_serial_sequence(%s, %s), coalesce(max({}), 0) + 1, false) FROM {}"
+                       .format(column, table), (table, column))
+
+
+def write_pdfs(cursor):
+    """Writes the placeholder PDF for every document having has_file set"""
+    with open(PLACEHOLDER_PDF, 'rb') as f:
+        pdf = f.read()
+    start = time.perf_counter()
+    cursor.execute('SELECT id FROM documents.documents WHERE has_file')
+    count = 0
+    for (id,) in cursor:
+        with open(document_path(id), 'wb') as f:
+            f.write(pdf)
+        count += 1
+    print('{}: {} files in {:.1f} s'.format(config.DOCUMENT_DIRECTORY, count, time.perf_counter() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--documents', type=int, default=100000)
+    parser.add_argument('--lectures', type=int, default=2000)
+    parser.add_argument('--examinants', type=int, default=1500)
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--deposits', type=int, default=5000)
+    parser.add_argument('--folders', type=int, default=50)
+    parser.add_argument('--lectures-per-document', type=float, default=2)
+    parser.add_argument('--examinants-per-document', type=float, default=1.5)
+    parser.add_argument('--documents-per-order', type=int, default=5)
+    parser.add_argument('--file-ratio', type=float, default=0.9, help='fraction of documents with has_file set')
+    parser.add_argument('--pdfs', action='store_true',
+                        help='write a placeholder PDF to DOCUMENT_DIRECTORY for every document with has_file set')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # just like the tests, this wipes tables
+    assert config.FlaskConfig.DEBUG and config.LOCAL_SERVER, "This script is destructive, I refuse to run it in production"
+
+    start = time.perf_counter()
+    connection = sqla.get_engine(app, 'garfield').raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('TRUNCATE {} RESTART IDENTITY CASCADE'.format(', '.join(TABLES)))
+        # counting the facets once afterwards is a lot faster than having the triggers count row by row
+        for table in FACET_TABLES:
+            cursor.execute('ALTER TABLE {} DISABLE TRIGGER facets'.format(table))
+        generate(cursor, args)
+        for table in FACET_TABLES:
+            cursor.execute('ALTER TABLE {} ENABLE TRIGGER facets'.format(table))
+        cursor.execute(str(FACET_BACKFILL))
+        reset_sequences(cursor)
+        # the planner's statistics are what estimated counts and the query cost guard work with
+        for table in TABLES + ['documents.lecture_facets', 'documents.examinant_facets']:
+            cursor.execute('ANALYZE {}'.format(table))
+        connection.commit()
+        if args.pdfs:
+            write_pdfs(cursor)
+    finally:
+        connection.close()
+    print('done in {:.1f} s'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
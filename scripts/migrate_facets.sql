@@ -0,0 +1,130 @@
+SET ROLE odie;
+
+CREATE TABLE documents.lecture_facets (
+	lecture_id INTEGER NOT NULL REFERENCES documents.lectures (id) ON DELETE CASCADE,
+	document_type documents.document_type NOT NULL,
+	department documents.department NOT NULL,
+	count INTEGER NOT NULL,
+	PRIMARY KEY (lecture_id, document_type, department)
+);
+
+CREATE TABLE documents.examinant_facets (
+	examinant_id INTEGER NOT NULL REFERENCES documents.examinants (id) ON DELETE CASCADE,
+	document_type documents.document_type NOT NULL,
+	count INTEGER NOT NULL,
+	PRIMARY KEY (examinant_id, document_type)
+);
+
+CREATE OR REPLACE FUNCTION documents.bump_lecture_facet(lec_id int, doc_type documents.document_type,
+		dep documents.department, delta int) RETURNS void AS $$
+BEGIN
+	IF doc_type IS NULL OR dep IS NULL THEN
+		RETURN;
+	END IF;
+	IF delta > 0 THEN
+		INSERT INTO lecture_facets (lecture_id, document_type, department, count) VALUES (lec_id, doc_type, dep, delta)
+		ON CONFLICT (lecture_id, document_type, department) DO UPDATE SET count = lecture_facets.count + EXCLUDED.count;
+	ELSE
+		-- never inserts: the lecture may be in the middle of being deleted
+		UPDATE lecture_facets SET count = count + delta
+		WHERE lecture_id = lec_id AND document_type = doc_type AND department = dep;
+		DELETE FROM lecture_facets WHERE lecture_id = lec_id AND document_type = doc_type AND department = dep AND count <= 0;
+	END IF;
+END
+$$ LANGUAGE plpgsql SET search_path = documents, pg_temp;
+
+CREATE OR REPLACE FUNCTION documents.bump_examinant_facet(ex_id int, doc_type documents.document_type, delta int)
+		RETURNS void AS $$
+BEGIN
+	IF doc_type IS NULL THEN
+		RETURN;
+	END IF;
+	IF delta > 0 THEN
+		INSERT INTO examinant_facets (examinant_id, document_type, count) VALUES (ex_id, doc_type, delta)
+		ON CONFLICT (examinant_id, document_type) DO UPDATE SET count = examinant_facets.count + EXCLUDED.count;
+	ELSE
+		UPDATE examinant_facets SET count = count + delta WHERE examinant_id = ex_id AND document_type = doc_type;
+		DELETE FROM examinant_facets WHERE examinant_id = ex_id AND document_type = doc_type AND count <= 0;
+	END IF;
+END
+$$ LANGUAGE plpgsql SET search_path = documents, pg_temp;
+
+CREATE OR REPLACE FUNCTION documents.lecture_docs_facets() RETURNS trigger AS $$
+BEGIN
+	-- links deleted by the cascade from a deleted document don't find it anymore, see documents_facets()
+	IF TG_OP IN ('DELETE', 'UPDATE') THEN
+		PERFORM bump_lecture_facet(OLD.lecture_id, doc.document_type, doc.department, -1)
+		FROM documents AS doc WHERE doc.id = OLD.document_id;
+	END IF;
+	IF TG_OP IN ('INSERT', 'UPDATE') THEN
+		PERFORM bump_lecture_facet(NEW.lecture_id, doc.document_type, doc.department, 1)
+		FROM documents AS doc WHERE doc.id = NEW.document_id;
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = documents, pg_temp;
+
+CREATE OR REPLACE FUNCTION documents.document_examinants_facets() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP IN ('DELETE', 'UPDATE') THEN
+		PERFORM bump_examinant_facet(OLD.examinant_id, doc.document_type, -1)
+		FROM documents AS doc WHERE doc.id = OLD.document_id;
+	END IF;
+	IF TG_OP IN ('INSERT', 'UPDATE') THEN
+		PERFORM bump_examinant_facet(NEW.examinant_id, doc.document_type, 1)
+		FROM documents AS doc WHERE doc.id = NEW.document_id;
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = documents, pg_temp;
+
+CREATE OR REPLACE FUNCTION documents.documents_facets() RETURNS trigger AS $$
+BEGIN
+	-- runs BEFORE DELETE, while the document's links still exist
+	IF TG_OP = 'DELETE' OR OLD.document_type IS DISTINCT FROM NEW.document_type
+			OR OLD.department IS DISTINCT FROM NEW.department THEN
+		PERFORM bump_lecture_facet(link.lecture_id, OLD.document_type, OLD.department, -1)
+		FROM lecture_docs AS link WHERE link.document_id = OLD.id;
+		PERFORM bump_examinant_facet(link.examinant_id, OLD.document_type, -1)
+		FROM document_examinants AS link WHERE link.document_id = OLD.id;
+	END IF;
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+	IF OLD.document_type IS DISTINCT FROM NEW.document_type OR OLD.department IS DISTINCT FROM NEW.department THEN
+		PERFORM bump_lecture_facet(link.lecture_id, NEW.document_type, NEW.department, 1)
+		FROM lecture_docs AS link WHERE link.document_id = NEW.id;
+		PERFORM bump_examinant_facet(link.examinant_id, NEW.document_type, 1)
+		FROM document_examinants AS link WHERE link.document_id = NEW.id;
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = documents, pg_temp;
+
+REVOKE ALL ON FUNCTION documents.bump_lecture_facet(int, documents.document_type, documents.department, int) FROM PUBLIC;
+REVOKE ALL ON FUNCTION documents.bump_examinant_facet(int, documents.document_type, int) FROM PUBLIC;
+
+CREATE TRIGGER facets AFTER INSERT OR UPDATE OR DELETE ON documents.lecture_docs
+FOR EACH ROW EXECUTE PROCEDURE documents.lecture_docs_facets();
+CREATE TRIGGER facets AFTER INSERT OR UPDATE OR DELETE ON documents.document_examinants
+FOR EACH ROW EXECUTE PROCEDURE documents.document_examinants_facets();
+CREATE TRIGGER facets_delete BEFORE DELETE ON documents.documents
+FOR EACH ROW EXECUTE PROCEDURE documents.documents_facets();
+CREATE TRIGGER facets_update AFTER UPDATE OF document_type, department ON documents.documents
+FOR EACH ROW EXECUTE PROCEDURE documents.documents_facets();
+
+-- count the existing documents
+DELETE FROM documents.lecture_facets;
+INSERT INTO documents.lecture_facets (lecture_id, document_type, department, count)
+SELECT link.lecture_id, doc.document_type, doc.department, count(*)
+FROM documents.lecture_docs AS link
+JOIN documents.documents AS doc ON doc.id = link.document_id
+WHERE doc.document_type IS NOT NULL AND doc.department IS NOT NULL
+GROUP BY link.lecture_id, doc.document_type, doc.department;
+DELETE FROM documents.examinant_facets;
+INSERT INTO documents.examinant_facets (examinant_id, document_type, count)
+SELECT link.examinant_id, doc.document_type, count(*)
+FROM documents.document_examinants AS link
+JOIN documents.documents AS doc ON doc.id = link.document_id
+WHERE doc.document_type IS NOT NULL
+GROUP BY link.examinant_id, doc.document_type;
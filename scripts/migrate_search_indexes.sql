@@ -0,0 +1,12 @@
+-- pg_trgm is a trusted extension since PostgreSQL 13; on older servers, run this line as a superuser
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+SET ROLE odie;
+
+CREATE OR REPLACE FUNCTION documents.lecture_aliases_text(aliases varchar[]) RETURNS text AS $$
+	SELECT array_to_string(aliases, ' ');
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE INDEX lectures_name_trgm ON documents.lectures USING gin (name gin_trgm_ops);
+CREATE INDEX lectures_aliases_trgm ON documents.lectures USING gin (documents.lecture_aliases_text(aliases) gin_trgm_ops);
+CREATE INDEX examinants_name_trgm ON documents.examinants USING gin (name gin_trgm_ops);
@@ -0,0 +1,55 @@
+SET ROLE odie;
+
+CREATE TABLE odie.table_versions (
+	table_name VARCHAR NOT NULL PRIMARY KEY,
+	version BIGINT NOT NULL,
+	changed_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION odie.bump_table_version() RETURNS trigger AS $$
+BEGIN
+	INSERT INTO odie.table_versions (table_name, version, changed_at)
+	VALUES (TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME, txid_current(), now())
+	ON CONFLICT (table_name) DO UPDATE SET version = EXCLUDED.version, changed_at = EXCLUDED.changed_at;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = odie, pg_temp;
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.documents
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.lectures
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.examinants
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.lecture_docs
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.document_examinants
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.folders
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.folder_docs
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.folder_lectures
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.folder_examinants
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.deposits
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents.deposit_lectures
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON odie.orders
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
+
+CREATE TRIGGER bump_table_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON odie.order_documents
+FOR EACH STATEMENT EXECUTE PROCEDURE odie.bump_table_version();
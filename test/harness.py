@@ -4,14 +4,79 @@ import config
 import json
 import os
 import subprocess
+import threading
 import unittest
+import urllib.parse
+
+from flask.testing import FlaskClient
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import HTTPException
 
 from odie import app, sqla
 from scripts import fill_data
 
 ODIE_DIR = os.path.join(os.path.dirname(__file__), os.pardir)
 
+
+class QueryCountingClient(FlaskClient):
+    """Test client failing any request that executes more SQL statements than its route's budget
+
+    Budgets map route names as returned by login.route_name() ('GET /api/documents') to the maximum number of
+    statements a single request may execute, including everything run while streaming the response and
+    all requests of a batch. Routes without a budget aren't checked.
+    Responses requested with buffered=False are streamed by the caller, so only the statements run until open()
+    returns are counted for them.
+    """
+    budgets = {}
+    # statements executed by the most recent request
+    last_statements = ()
+
+    def open(self, *args, **kwargs):
+        # the body has to be read here, otherwise queries issued while streaming it wouldn't be counted
+        kwargs.setdefault('buffered', True)
+        route = self._route_name(args[0] if args else kwargs.get('path', '/'), kwargs.get('method', 'GET'))
+        thread = threading.get_ident()
+        statements = []
+
+        # only count our own thread's statements: the session refresh flushes run in the background
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if threading.get_ident() == thread:
+                statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', count)
+        try:
+            response = super().open(*args, **kwargs)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count)
+        self.last_statements = statements
+
+        budget = self.budgets.get(route)
+        if budget is not None and len(statements) > budget:
+            raise AssertionError('{} executed {} SQL statements, its budget is {}:\n{}'.format(
+                    route, len(statements), budget,
+                    '\n'.join('{:3}: {}'.format(i, ' '.join(s.split())) for (i, s) in enumerate(statements, 1))))
+        return response
+
+    @staticmethod
+    def _route_name(path, method):
+        if not isinstance(path, str):
+            return None  # EnvironBuilder etc. aren't used by our tests
+        method = method.upper()
+        try:
+            (rule, _) = app.url_map.bind('localhost').match(urllib.parse.urlsplit(path).path, method=method,
+                                                             return_rule=True)
+        except HTTPException:  # includes RequestRedirect
+            return None
+        return '{} {}'.format(method, rule.rule)
+
+
+app.test_client_class = QueryCountingClient
+
+
 class OdieTestCase(unittest.TestCase):
+    # route name -> maximum number of SQL statements per request, see QueryCountingClient
+    QUERY_BUDGETS = {}
 
     def fromJsonResponse(self, response):
         data = json.loads(response.data.decode('utf-8'))
@@ -28,6 +93,7 @@ class OdieTestCase(unittest.TestCase):
         subprocess.call([os.path.join(ODIE_DIR, 'scripts', 'delete_everything_in_all_databases.sh')], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         subprocess.call([os.path.join(ODIE_DIR, 'scripts', 'create_schemas_and_tables.py')], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
+        QueryCountingClient.budgets = cls.QUERY_BUDGETS
         cls.app = app.test_client()
 
     @staticmethod
@@ -2,17 +2,41 @@
 
 from test.harness import OdieTestCase, ODIE_DIR
 
+import api_utils
+import concurrent.futures
 import config
 import datetime
+import gzip
 import os
 import routes
 import json
+import login
+import metrics
 import random
+import db.acl as acl
+import db.fsmi as fsmi
 
-from flask import session
+from unittest import mock
+
+from flask import g, session
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Query, undefer
+
+from db.documents import Deposit, Document, Examinant, Lecture
+from db.odie import Order
+from odie import app, csrf, sqla
+from routes.common import DocumentDumpSchema
+from routes.documents import LectureDumpSchema
+from routes.misc import DepositDumpSchema, OrderDumpSchema
+
+
+# routes can't be added once the app has served its first request
+@api_utils.api_route('/api/test/statement_timeout', statement_timeout=0.05)
+def statement_timeout_route():
+    sqla.session.execute('SELECT pg_sleep(1)')
+    return {}
 
-from db.documents import Document, Lecture
-from odie import app, csrf
 
 class APITest(OdieTestCase):
     VALID_USER = 'guybrush'
@@ -51,6 +75,34 @@ class APITest(OdieTestCase):
             'amount': 42,
         }
 
+    # Generous upper bounds, so that N+1 patterns fail the tests instead of being noticed in production. Besides
+    # the route's own queries, these include authentication, SET LOCAL statement_timeout, table version lookups
+    # and the fsmi session refresh.
+    QUERY_BUDGETS = {
+            'GET /api/config': 6,
+            'GET /api/user_info': 5,
+            'GET /api/metrics': 6,
+            'GET /api/lectures': 8,
+            'GET /api/examinants': 8,
+            'GET /api/search/lectures': 7,
+            'GET /api/search/examinants': 7,
+            'GET /api/documents': 12,
+            'GET /api/documents/meta': 8,
+            'POST /api/documents': 16,
+            'GET /api/orders': 12,
+            'POST /api/orders': 8,
+            'DELETE /api/orders/<int:instance_id>': 10,
+            'GET /api/deposits': 10,
+            'GET /api/batch': 10,
+            'GET /api/print': 10,
+            'POST /api/log_erroneous_sale': 5,
+            'POST /api/log_deposit_return': 10,
+            'POST /api/log_early_document_reward': 8,
+            'POST /api/donation': 5,
+            'POST /login': 5,
+            'GET /logout': 5,
+        }
+
     token = None
 
     def login(self, user=VALID_USER, password=VALID_PASS):
@@ -129,11 +181,55 @@ class APITest(OdieTestCase):
         data = self.fromJsonResponse(res)
         all_docs = Lecture.query.get(1).documents.all()
         self.assertEqual(len(all_docs), data['total_written'] + data['total_oral'])
+        self.assertEqual(len(all_docs), sum(data['by_department'].values()))
+        self.assertEqual({str(doc.date.year) for doc in all_docs}, set(data['by_year']))
+
+    def test_get_documents_meta_invalidation(self):
+        def total_oral():
+            return self.fromJsonResponse(self.get('/api/documents/meta'))['total_oral']
+        self.assertEqual(total_oral(), 7)
+        Document.query.filter_by(id=1).update({'document_type': 'written'})
+        sqla.session.commit()
+        self.assertEqual(total_oral(), 6)
 
     def test_get_examinants(self):
         res = self.get('/api/examinants')
         self.fromJsonResponse(res)
 
+    def test_lecture_facets(self):
+        def facets(lecture_id):
+            lectures = self.fromJsonResponse(self.get('/api/lectures'))
+            return next(lecture['facets'] for lecture in lectures if lecture['id'] == lecture_id)
+        self.assertEqual(facets(1), [{'document_type': 'oral', 'department': 'computer science', 'count': 1}])
+        doc = Document.query.get(1)
+        doc.document_type = 'written'
+        sqla.session.commit()
+        self.assertEqual(facets(1), [{'document_type': 'written', 'department': 'computer science', 'count': 1}])
+        sqla.session.delete(doc)
+        sqla.session.commit()
+        self.assertEqual(facets(1), [])
+
+    def test_examinant_facets(self):
+        examinants = self.fromJsonResponse(self.get('/api/examinants'))
+        anon = next(examinant for examinant in examinants if examinant['name'] == 'Anon Ymous')
+        self.assertEqual(anon['facets'], [{'document_type': 'oral', 'count': 5}])
+
+    def test_search_lectures(self):
+        res = self.get('/api/search/lectures?q=redund')
+        self.assertEqual([l['name'] for l in self.fromJsonResponse(res)], ['Einführung in Redundanz'])
+        # aliases are searched, too
+        res = self.get('/api/search/lectures?q=MTTK')
+        self.assertEqual([l['name'] for l in self.fromJsonResponse(res)], ['Mensch-Toastbrot-Toaster-Kommunikation'])
+        res = self.get('/api/search/lectures?q=einf&limit=1')
+        self.assertEqual(len(self.fromJsonResponse(res)), 1)
+        self.assertEqual(self.get('/api/search/lectures?q=').status_code, 400)
+
+    def test_search_examinants(self):
+        res = self.get('/api/search/examinants?q=zartb')
+        self.assertEqual([e['name'] for e in self.fromJsonResponse(res)], ['Martina Zartbitter'])
+        res = self.get('/api/search/examinants?q=100%25')
+        self.assertEqual(self.fromJsonResponse(res), [])
+
     def test_no_kiosk_handover_unauthenticated(self):
         res = self.get('/kiosk')
         self.assertEqual(res.status_code, 401)
@@ -200,6 +296,125 @@ class APITest(OdieTestCase):
         self.logout()
         self.assertFalse(is_logged_in())
 
+    def _session_cookie(self):
+        self.login()
+        user = fsmi.User.query.filter_by(username=self.VALID_USER).one()
+        cookie = fsmi.Cookie.query.filter_by(user_id=user.id).one()
+        return (cookie.sid, cookie.user_id, cookie.lifetime)
+
+    def test_session_refresh_throttled(self):
+        self._session_cookie()
+        cookies = fsmi.Cookie.query.count()
+        # a dummy flush thread, so that nothing is written behind our backs
+        with mock.patch.object(config, 'LOCAL_SERVER', False), mock.patch.object(fsmi, '_flush_thread', object()):
+            for _ in range(3):
+                self.assertEqual(self.get('/api/user_info').status_code, 200)
+            self.assertEqual(fsmi._pending_refreshes, {})
+            fsmi.flush_refreshes()
+        self.assertEqual(fsmi.Cookie.query.count(), cookies)
+
+    def test_session_refresh_flush(self):
+        (sid, user_id, lifetime) = self._session_cookie()
+        stale = datetime.datetime.now() - datetime.timedelta(seconds=config.SESSION_REFRESH_INTERVAL + 1)
+        with mock.patch.object(config, 'LOCAL_SERVER', False), mock.patch.object(fsmi, '_flush_thread', object()):
+            first = fsmi.refresh_session(sid, user_id, stale, lifetime)
+            newest = fsmi.refresh_session(sid, user_id, stale, lifetime)
+            self.assertTrue(stale < first <= newest)
+            # coalesced into a single pending write with the newest time
+            self.assertEqual(fsmi._pending_refreshes, {sid: (user_id, newest, lifetime)})
+            fsmi.flush_refreshes()
+        self.assertEqual(fsmi._pending_refreshes, {})
+        last_actions = [cookie.last_action for cookie in fsmi.Cookie.query.filter_by(sid=sid)]
+        self.assertEqual(max(last_actions), newest)
+
+    def test_session_cache_hit(self):
+        def cookie_lookups():
+            self.assertEqual(self.get('/api/user_info').status_code, 200)
+            return [stmt for stmt in self.app.last_statements if 'cookies' in stmt]
+        self._session_cookie()
+        login._session_cache.clear()
+        self.assertEqual(len(cookie_lookups()), 1)
+        miss_statements = len(self.app.last_statements)
+        self.assertEqual(cookie_lookups(), [])
+        self.assertLess(len(self.app.last_statements), miss_statements)
+
+    def test_session_newest_row(self):
+        (sid, user_id, lifetime) = self._session_cookie()
+        newest = fsmi.Cookie.query.filter_by(sid=sid).one().last_action
+        sqla.session.add(fsmi.Cookie(sid=sid, user_id=user_id, last_action=newest - datetime.timedelta(days=1),
+                                     lifetime=lifetime))
+        sqla.session.commit()
+        login._session_cache.clear()
+        self.assertEqual(self.get('/api/user_info').status_code, 200)
+        self.assertEqual(login._session_cache.get(sid).last_action, newest)
+
+    def test_session_cache_logout(self):
+        (sid, _, _) = self._session_cookie()
+        self.assertIsNotNone(login._session_cache.get(sid))
+        self.logout()
+        self.assertIsNone(login._session_cache.get(sid))
+        self.assertEqual(self.get('/api/user_info').status_code, 401)
+
+    def test_session_cache_expiry(self):
+        (sid, _, _) = self._session_cookie()
+        cached = login._session_cache.get(sid)
+        cached.last_action -= datetime.timedelta(seconds=cached.lifetime + 1)
+        # in the real database, the cookies view hides expired sessions
+        fsmi.Cookie.query.filter_by(sid=sid).delete()
+        sqla.session.commit()
+        self.assertEqual(self.get('/api/user_info').status_code, 401)
+        self.assertIsNone(login._session_cache.get(sid))
+
+    def test_permission_masks(self):
+        groups = [('fsusers',), ('homepage_login',), ('info_klausuren', 'info_protokolle'), ('adm', 'partying'),
+                  ('does_not_exist',)]
+        # guybrush and lechuck lack fsusers, elaine and admin have several groups
+        for user in fsmi.User.query.all():
+            names = {perm.name for perm in user.effective_permissions}
+            session_user = login.SessionUser.from_user(user)
+            for group in groups:
+                expected = bool(names & set(group))
+                self.assertEqual(user.has_permission(*group), expected, (user.username, group))
+                self.assertEqual(session_user.has_permission(*group), expected, (user.username, group))
+
+    def test_permission_reload(self):
+        acl._load_permission_bits()  # so the reload interval has only just started
+        perm = acl.Permission(name='new_perm')
+        sqla.session.add(perm)
+        sqla.session.commit()
+        self.assertEqual(acl.permission_mask('new_perm'), 0)
+        with mock.patch.object(acl, '_last_load', datetime.datetime.now() - acl._RELOAD_INTERVAL * 2):
+            self.assertEqual(acl.permission_mask('new_perm'), 1 << perm.id)
+
+    def test_login_overloaded(self):
+        held = 0
+        while fsmi._password_slots.acquire(blocking=False):
+            held += 1
+        try:
+            res = self.post('/login', data={'username': self.VALID_USER, 'password': self.VALID_PASS})
+            self.assertEqual(res.status_code, 503)
+        finally:
+            for _ in range(held):
+                fsmi._password_slots.release()
+        self.assertEqual(self.login().status_code, 200)
+
+    def test_login_timeout(self):
+        futures = []
+
+        class StuckPool(object):
+            def submit(self, fn, *args):
+                futures.append(concurrent.futures.Future())
+                return futures[-1]
+
+        with mock.patch.object(fsmi, '_password_pool', StuckPool()), \
+                mock.patch.object(config, 'PASSWORD_POOL_TIMEOUT', 0.01):
+            res = self.post('/login', data={'username': self.VALID_USER, 'password': self.VALID_PASS})
+        self.assertEqual(res.status_code, 503)
+        # the abandoned verification is cancelled, which gives its slot back
+        self.assertEqual(len(futures), 1)
+        self.assertTrue(futures[0].cancelled())
+        self.assertEqual(self.login().status_code, 200)
+
     def test_user_info_get_authenticated(self):
         self.login()
         res = self.get('/api/user_info')
@@ -208,6 +423,86 @@ class APITest(OdieTestCase):
         self.assertIn('user', data)
         self.assertIn('token', data)
 
+    def test_batch(self):
+        urls = ['/api/config', '/api/user_info', '/api/lectures', '/api/documents?q={"page":1}']
+        res = self.get('/api/batch?requests=%s' % json.dumps(urls, separators=(',', ':')))
+        data = self.fromJsonResponse(res)
+        self.assertEqual(sorted(data), sorted(urls))
+        self.assertEqual(data['/api/user_info']['status'], 401)
+        self.assertEqual(data['/api/config']['status'], 200)
+        self.assertIn('PRICE_PER_PAGE', data['/api/config']['body']['data'])
+        self.assertEqual(data['/api/lectures']['body'], json.loads(self.get('/api/lectures').data.decode('utf-8')))
+        self.assertEqual(data['/api/documents?q={"page":1}']['body']['total'], 7)
+
+    def test_batch_logged_in(self):
+        self.login()
+        res = self.get('/api/batch?requests=["/api/user_info"]')
+        data = self.fromJsonResponse(res)
+        self.assertEqual(data['/api/user_info']['body']['data']['user']['username'], self.VALID_USER)
+
+    def test_batch_invalid_url(self):
+        for url in ('http://example.com/api/config', '/login', '/api/batch'):
+            res = self.get('/api/batch?requests=%s' % json.dumps([url], separators=(',', ':')))
+            self.assertEqual(res.status_code, 400)
+
+    def test_batch_statement_timeouts(self):
+        timeouts = []
+
+        def record(session, transaction, connection):
+            timeouts.append(g._statement_timeout)
+        urls = ['/api/test/statement_timeout', '/api/documents', '/api/config']
+        event.listen(sqla.session, 'after_begin', record)
+        try:
+            with mock.patch.object(routes.misc, 'BATCHABLE_ROUTES', routes.misc.BATCHABLE_ROUTES | {urls[0]}):
+                data = self.fromJsonResponse(self.get('/api/batch?requests=%s' % json.dumps(urls, separators=(',', ':'))))
+        finally:
+            event.remove(sqla.session, 'after_begin', record)
+        self.assertEqual(data[urls[0]]['status'], 503)
+        self.assertEqual(data[urls[1]]['status'], 200)
+        self.assertEqual(data[urls[2]]['status'], 200)
+        self.assertIn(0.05, timeouts)
+        self.assertIn(config.JSONQUERY_STATEMENT_TIMEOUT, timeouts)
+        self.assertIn(config.DEFAULT_STATEMENT_TIMEOUT, timeouts)
+
+    def test_batch_refuses_streams(self):
+        self.login()
+        self.app.set_cookie('localhost', 'print_data', json.dumps(self.VALID_PRINTJOB))
+        for url in ('/api/print', '/api/scanner/FSI/1', '/api/view/1'):
+            res = self.get('/api/batch?requests=%s' % json.dumps([url], separators=(',', ':')))
+            self.assertEqual(res.status_code, 400)
+        self.app.delete_cookie('localhost', 'print_data')
+
+    def test_metrics_no_get_unauthenticated(self):
+        res = self.get('/api/metrics')
+        self.assertEqual(res.status_code, 401)
+
+    def test_metrics_no_get_without_admin_permission(self):
+        self.login()
+        res = self.get('/api/metrics')
+        self.assertEqual(res.status_code, 401)
+
+    def test_get_user_memoized(self):
+        self.login('elaine', 'arrrrr')
+        self.get('/api/documents')
+        res = self.get('/api/metrics')
+        data = self.fromJsonResponse(res)
+        self.assertTrue(data['get_user_memoized']['GET /api/documents'] > 0)
+
+    def test_api_token(self):
+        self.login()
+        token = self.fromJsonResponse(self.get('/api/user_info?api_token=1'))['api_token']
+        with app.test_client() as c:
+            res = c.get('/api/user_info', headers={'Authorization': 'Bearer ' + token})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(self.fromJsonResponse(res)['user']['username'], self.VALID_USER)
+            # tokens can't be used to get new tokens
+            res = c.get('/api/user_info?api_token=1', headers={'Authorization': 'Bearer ' + token})
+            self.assertNotIn('api_token', self.fromJsonResponse(res))
+
+    def test_invalid_api_token(self):
+        res = self.app.get('/api/user_info', headers={'Authorization': 'Bearer ' + self.UNUSED})
+        self.assertEqual(res.status_code, 401)
+
     ## tests for authenticated api ##
 
     def do_print(self, job, auth=False):
@@ -421,6 +716,250 @@ class APITest(OdieTestCase):
             self.assertEqual([], [True for item in data['data'] if item['id'] in ids_seen])
             ids_seen += [item['id'] for item in data['data']]
 
+    def test_cursor_pagination(self):
+        self.enable_pagination(2)
+        self._add_a_page_of_orders()
+        self._add_a_page_of_orders()
+        self.login()
+        res = self.get('/api/orders?q={"cursor":null}')
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertNotIn('total', data)
+        self.assertIsNone(data['prev'])
+        first_page = [item['id'] for item in data['data']]
+        ids_seen = list(first_page)
+        while data['next'] is not None:
+            res = self.get('/api/orders?q=%s' % json.dumps({'cursor': data['next']}, separators=(',', ':')))
+            self.assertEqual(res.status_code, 200)
+            data = json.loads(res.data.decode('utf-8'))
+            self.assertEqual([], [True for item in data['data'] if item['id'] in ids_seen])
+            ids_seen += [item['id'] for item in data['data']]
+        self.assertEqual(ids_seen, sorted(ids_seen))
+        self.assertEqual(len(ids_seen), 4 + 2 * config.ITEMS_PER_PAGE)
+
+        # walk back to the start
+        while data['prev'] is not None:
+            res = self.get('/api/orders?q=%s' % json.dumps({'cursor': data['prev']}, separators=(',', ':')))
+            data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual([item['id'] for item in data['data']], first_page)
+
+    def test_cursor_pagination_sorted_anonymous(self):
+        self.enable_pagination(2)
+        dates = []
+        q = {'operator': 'order_by_desc', 'column': 'date', 'cursor': None}
+        while True:
+            data = json.loads(self.get('/api/documents?q=%s' % json.dumps(q, separators=(',', ':'))).data.decode('utf-8'))
+            dates += [doc['date'] for doc in data['data']]
+            if data['next'] is None:
+                break
+            q['cursor'] = data['next']
+        self.assertEqual(len(dates), 7)
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+    def test_pagination_without_count(self):
+        self.login()
+        res = self.get('/api/orders?count=none')
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertNotIn('total', data)
+        self.assertNotIn('number_of_pages', data)
+        self.assertEqual(len(data['data']), 4)
+
+    def test_pagination_estimated_count_invalidation(self):
+        def total():
+            res = self.get('/api/documents?count=estimated')
+            return json.loads(res.data.decode('utf-8'))['total']
+        self.assertEqual(total(), 7)
+        self.assertEqual(total(), 7)
+        self.assertEqual(self._upload_document().status_code, 200)
+        self.assertEqual(total(), 8)
+
+    def test_invalid_cursor(self):
+        res = self.get('/api/documents?q=%s' % json.dumps({'cursor': self.UNUSED}, separators=(',', ':')))
+        self.assertEqual(res.status_code, 400)
+        for cursor in (1, True, ['x'], {'x': 1}):
+            res = self.get('/api/documents?q=%s' % json.dumps({'cursor': cursor}, separators=(',', ':')))
+            self.assertEqual(res.status_code, 400)
+
+    def test_conditional_get(self):
+        res = self.get('/api/documents')
+        self.assertEqual(res.status_code, 200)
+        etag = res.headers['ETag']
+        res = self.get('/api/documents', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        res = self.get('/api/documents', headers={'If-Modified-Since': res.headers['Last-Modified']})
+        self.assertEqual(res.status_code, 304)
+
+        self.assertEqual(self._upload_document().status_code, 200)
+        res = self.get('/api/documents', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_conditional_get_per_user(self):
+        etag = self.get('/api/documents').headers['ETag']
+        self.login()
+        res = self.get('/api/documents', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('submitted_by', self.fromJsonResponse(res)[0])
+
+    def test_statement_timeout(self):
+        sqla.session.commit()
+        with app.test_request_context():
+            g._statement_timeout = 0.05
+            with self.assertRaises(OperationalError) as cm:
+                sqla.session.execute('SELECT pg_sleep(1)')
+            self.assertEqual(cm.exception.orig.pgcode, '57014')
+            sqla.session.rollback()
+
+    def test_statement_timeout_route(self):
+        route = 'GET /api/test/statement_timeout'
+        timeouts = metrics.snapshot().get('statement_timeouts', {}).get(route, 0)
+        res = self.get('/api/test/statement_timeout')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(json.loads(res.data.decode('utf-8'))['errors'], ['query timed out'])
+        self.assertEqual(metrics.snapshot()['statement_timeouts'][route], timeouts + 1)
+        # the aborted transaction has been rolled back
+        self.assertEqual(sqla.session.execute('SELECT 1').scalar(), 1)
+        self.assertEqual(len(self.fromJsonResponse(self.get('/api/documents'))), 7)
+
+    def test_sparse_fields(self):
+        documents = self.fromJsonResponse(self.get('/api/documents?fields=id,date,validated'))
+        self.assertEqual(len(documents), 7)
+        for doc in documents:
+            self.assertEqual(set(doc), {'id', 'date', 'validated'})
+        full = self.fromJsonResponse(self.get('/api/documents'))
+        self.assertEqual(documents, [{key: doc[key] for key in ('id', 'date', 'validated')} for doc in full])
+
+        lectures = self.fromJsonResponse(self.get('/api/lectures?fields=name,early_document_eligible'))
+        self.assertEqual(set(lectures[0]), {'name', 'early_document_eligible'})
+
+    def test_sparse_fields_method(self):
+        self.login()
+        documents = self.fromJsonResponse(self.get('/api/documents?fields=id,submitted_by'))
+        full = self.fromJsonResponse(self.get('/api/documents'))
+        self.assertEqual(documents, [{key: doc[key] for key in ('id', 'submitted_by')} for doc in full])
+        with app.test_request_context('/api/documents'):
+            query = Document.query
+            self.assertIs(api_utils._sparse_query(query, DocumentDumpSchema, ['id', 'submitted_by']), query)
+
+    def test_sparse_fields_unknown(self):
+        self.assertEqual(self.get('/api/documents?fields=id,secret').status_code, 400)
+
+    def test_sparse_fields_invalid_q(self):
+        self.login()
+        self.assertEqual(self.get('/api/orders?q=[]&fields=id').status_code, 400)
+
+    def test_query_budget(self):
+        with mock.patch.dict(self.QUERY_BUDGETS, {'GET /api/lectures': 0}):
+            with self.assertRaisesRegex(AssertionError, r'(?s)GET /api/lectures executed \d+ SQL statements.*SELECT'):
+                self.get('/api/lectures')
+
+    def test_query_count_independent_of_rows(self):
+        self.login()
+        urls = ('/api/documents?count=exact', '/api/orders')
+        before = {}
+        for url in urls:
+            self.fromJsonResponse(self.get(url))
+            before[url] = len(self.app.last_statements)
+
+        lectures = Lecture.query.all()
+        examinants = Examinant.query.all()
+        for i in range(20):
+            sqla.session.add(Document(department='computer science', lectures=lectures, examinants=examinants,
+                                      date=datetime.date(2010, 1, 1), number_of_pages=1, document_type='oral',
+                                      early_document_eligible=False, deposit_return_eligible=False))
+            sqla.session.add(Order(name='order %d' % i, document_ids=[1, 2]))
+        sqla.session.commit()
+
+        for url in urls:
+            data = self.fromJsonResponse(self.get(url))
+            self.assertGreaterEqual(len(data), 20)
+            self.assertEqual(len(self.app.last_statements), before[url], url)
+
+    def test_server_timing(self):
+        self.login()
+        res = self.get('/api/documents')
+        phases = [metric.split(';')[0] for metric in res.headers['Server-Timing'].split(', ')]
+        for phase in ('auth', 'query', 'serialize', 'encode', 'total'):
+            self.assertIn(phase, phases)
+
+    def test_slow_request_log(self):
+        old_threshold = config.SLOW_REQUEST_THRESHOLD
+        config.SLOW_REQUEST_THRESHOLD = 0
+        try:
+            with self.assertLogs('odie.slow_requests') as logs:
+                res = self.get('/api/examinants')
+                self.fromJsonResponse(res)
+                res.close()
+        finally:
+            config.SLOW_REQUEST_THRESHOLD = old_threshold
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual(entry['route'], 'GET /api/examinants')
+        self.assertTrue(entry['sql_statements'] > 0)
+        self.assertIn('stream', entry['phases_ms'])
+
+    def _assert_precompiled(self, objs, schema):
+        self.assertTrue(objs)
+        self.assertEqual(api_utils.serialize(objs, schema, many=True), schema().dump(objs, many=True))
+        self.assertEqual(api_utils.serialize(objs[0], schema), schema().dump(objs[0]))
+
+    def test_precompiled_serializers(self):
+        documents = Document.query.all()
+        for user in (None, login.SessionUser.from_user(fsmi.User.query.filter_by(username=self.VALID_USER).one())):
+            with app.test_request_context():
+                g._user = user
+                dumped = api_utils.serialize(documents, DocumentDumpSchema, many=True)
+                self.assertEqual(any('submitted_by' in doc for doc in dumped), user is not None)
+                self._assert_precompiled(documents, DocumentDumpSchema)
+        with app.test_request_context():
+            self._assert_precompiled(Order.query.all(), OrderDumpSchema)
+            self._assert_precompiled(Lecture.query.options(undefer('early_document_until'), undefer('facets')).all(),
+                                     LectureDumpSchema)
+            self._assert_precompiled(Deposit.query.all(), DepositDumpSchema)
+
+    def test_streamed_response(self):
+        with app.test_request_context('/api/lectures'):
+            query = Lecture.query.options(undefer('early_document_until'), undefer('facets'))
+            expected = {'data': api_utils.filtered_results(query, LectureDumpSchema, paginate=False)}
+        self.assertTrue(expected['data'])
+
+        yield_per = Query.yield_per
+        with mock.patch.object(Query, 'yield_per', autospec=True, side_effect=yield_per) as streamed, \
+                mock.patch.object(Query, 'all', side_effect=AssertionError('rows fetched as a list')):
+            res = self.app.get('/api/lectures', headers={'Accept': 'application/json'}, buffered=False)
+            self.assertTrue(res.is_streamed)
+            data = b''.join(res.response)
+            res.close()
+        self.assertEqual(json.loads(data.decode('utf-8')), expected)
+        streamed.assert_called_once_with(mock.ANY, config.STREAM_BATCH_SIZE)
+
+    def test_documents_response_cache(self):
+        url = '/api/documents?q={"operator":"order_by_desc","column":"date","page":1}'
+        first = self.get(url)
+        self.assertEqual(self.get(url).data, first.data)
+        self.assertEqual(json.loads(first.data.decode('utf-8'))['total'], 7)
+
+        self.assertEqual(self._upload_document().status_code, 200)
+        self.assertEqual(json.loads(self.get(url).data.decode('utf-8'))['total'], 8)
+
+    def test_compressed_responses(self):
+        for url in ('/api/lectures', '/api/documents'):
+            plain = self.get(url)
+            self.assertNotIn('Content-Encoding', plain.headers)
+            res = self.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(res.data), plain.data)
+
+    def test_cached_response_variants(self):
+        routes.documents._response_cache.clear()
+        plain = self.get('/api/documents')
+        res = self.get('/api/documents', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        [(cached, _, _)] = routes.documents._response_cache._entries.values()
+        # only what has been asked for is compressed
+        self.assertEqual(set(cached.variants), {'gzip'})
+
     DOCUMENT_SUBMISSION_JSON = {
                 'lectures': [
                     "Fortgeschrittenes Nichtstun",
@@ -547,6 +1086,68 @@ class APITest(OdieTestCase):
             self.assertTrue(last_name <= item['name'])
             last_name = item['name']
 
+    def test_jsonquery_cost_limit(self):
+        self.login()
+        req = '/api/orders?q={"operator":"like","column":"name","value":"%x%"}'
+        self.assertEqual(self.get(req).status_code, 200)
+        old_max_cost = config.JSONQUERY_MAX_COST
+        config.JSONQUERY_MAX_COST = 0
+        try:
+            self.assertEqual(self.get(req).status_code, 400)
+        finally:
+            config.JSONQUERY_MAX_COST = old_max_cost
+
+    def test_jsonquery_cost_only_for_filters(self):
+        self.login()
+        api_utils._query_costs.clear()
+        old_max_cost = config.JSONQUERY_MAX_COST
+        config.JSONQUERY_MAX_COST = 0
+        try:
+            for q in ('{"page":1}', '{"cursor":null}'):
+                self.assertEqual(self.get('/api/orders?q=' + q).status_code, 200)
+                self.assertFalse([s for s in self.app.last_statements if s.startswith('EXPLAIN')])
+            self.assertEqual(self.get('/api/orders?q={"operator":"like","column":"name","value":"%x%"}').status_code, 400)
+            [explain] = [s for s in self.app.last_statements if s.startswith('EXPLAIN')]
+            self.assertIn('LIMIT', explain)
+        finally:
+            config.JSONQUERY_MAX_COST = old_max_cost
+
+        def explained():
+            return sorted('LIMIT' in s for s in self.app.last_statements if s.startswith('EXPLAIN'))
+
+        # the total is counted, too: count=exact on every request...
+        api_utils._query_costs.clear()
+        self.assertEqual(self.get('/api/orders?q={"operator":"like","column":"name","value":"%x%"}').status_code, 200)
+        self.assertEqual(explained(), [False, True])
+        # ...count=estimated unless it's cached
+        api_utils._count_cache.clear()
+        url = '/api/documents?q={"operator":"==","column":"department","value":"mathematics"}'
+        self.fromJsonResponse(self.get(url))
+        self.assertEqual(explained(), [False, True])
+        api_utils._query_costs.clear()
+        self.fromJsonResponse(self.get(url))
+        self.assertEqual(explained(), [True])
+
+    def test_jsonquery_same_shape_different_values(self):
+        self.login()
+        orders = self.fromJsonResponse(self.get('/api/orders'))
+        self.assertTrue(len(orders) > 1)
+        for order in orders:
+            q = json.dumps({'operator': '==', 'column': 'name', 'value': order['name']}, separators=(',', ':'))
+            data = self.fromJsonResponse(self.get('/api/orders?q=%s' % q))
+            self.assertEqual([d['id'] for d in data], [order['id']])
+
+    def test_jsonquery_templates(self):
+        self.login()
+        api_utils._jsonquery_templates.clear()
+        orders = self.fromJsonResponse(self.get('/api/orders'))
+        for names in ([orders[0]['name']], [orders[1]['name']], [orders[0]['name'], orders[1]['name']]):
+            q = json.dumps({'operator': 'in_', 'column': 'name', 'value': names}, separators=(',', ':'))
+            data = self.fromJsonResponse(self.get('/api/orders?q=%s' % q))
+            self.assertEqual(sorted(d['name'] for d in data), sorted(names))
+        # one template per list length
+        self.assertEqual(len(api_utils._jsonquery_templates._entries), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
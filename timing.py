@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+
+# Per-request phase timers (auth, query, serialize, encode, stream), reported in the Server-Timing header and,
+# for requests taking longer than SLOW_REQUEST_THRESHOLD, in the 'odie.slow_requests' log.
+# Phases nest: time spent in an inner phase (e.g. SQL issued while serializing) only counts for the inner one.
+
+import collections
+import config
+import json
+import logging
+import time
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_request_log = logging.getLogger('odie.slow_requests')
+
+
+class RequestTimer(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.totals = collections.OrderedDict()
+        self.statements = 0
+        self._stack = []
+
+    def push(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            self._charge(now)
+        self._stack.append([name, now])
+
+    def pop(self, name=None):
+        """Ends the innermost phase (if it's `name`, when given)"""
+        if name is not None and (not self._stack or self._stack[-1][0] != name):
+            return
+        now = time.perf_counter()
+        if self._stack:
+            self._charge(now)
+            self._stack.pop()
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def _charge(self, now):
+        (name, since) = self._stack[-1]
+        self.totals[name] = self.totals.get(name, 0) + now - since
+        self._stack[-1][1] = now
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        """Server-Timing header value for the phases so far"""
+        metrics = ['{};dur={:.1f}'.format(name, 1000 * seconds) for (name, seconds) in self.totals.items()]
+        metrics.append('total;dur={:.1f}'.format(1000 * self.elapsed()))
+        return ', '.join(metrics)
+
+    def phases_ms(self):
+        return {name: round(1000 * seconds, 1) for (name, seconds) in self.totals.items()}
+
+
+def current():
+    """Returns the timer of the current request, or None outside of requests"""
+    if not has_request_context():
+        return None
+    # kept in the environ instead of g, since batched requests share their g
+    timer = request.environ.get('odie.timer')
+    if timer is None:
+        timer = request.environ['odie.timer'] = RequestTimer()
+    return timer
+
+
+class phase(object):
+    """Context manager timing a phase of the current request (or of `timer`, where there's no request context)"""
+
+    def __init__(self, name, timer=None):
+        self.name = name
+        self.timer = timer
+
+    def __enter__(self):
+        if self.timer is None:
+            self.timer = current()
+        if self.timer is not None:
+            self.timer.push(self.name)
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.pop()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timer = current()
+    if timer is not None:
+        timer.statements += 1
+        timer.push('query')
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timer = current()
+    if timer is not None:
+        timer.pop('query')
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # statements failing in the database don't get an after_cursor_execute
+    timer = current()
+    if timer is not None:
+        timer.pop('query')
+
+
+def log_if_slow(timer, **details):
+    """Writes a request to the slow request log if it took longer than SLOW_REQUEST_THRESHOLD seconds"""
+    elapsed = timer.elapsed()
+    if elapsed < config.SLOW_REQUEST_THRESHOLD:
+        return
+    entry = dict(details, total_ms=round(1000 * elapsed, 1), phases_ms=timer.phases_ms(),
+                 sql_statements=timer.statements)
+    slow_request_log.warning(json.dumps(entry, default=str))